@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+#coding=utf-8
+
+##
+# @file:   xls_pb_bench.py
+# @brief:  导表工具的性能测试
+#
+# 不需要excel文件，按三个方向生成模拟的页签：
+#     tall   行数很多
+#     wide   列数很多，路径很深(a.b.c)
+#     repeat 重复次数很多的结构体数组
+# 分阶段计时：建描述树、生成proto、protoc/import、编译解码计划、解析数据、序列化、写文本，结果输出为json。
+#
+# 用法(在common_def.py所在目录执行)：
+#     ./xls_pb_bench.py --rows 100000 --cols 1500 --repeat 200 --output bench_result.json
+##
+import sys
+import os
+import json
+import random
+import timeit
+
+import xls_pb_tool
+from xls_pb_tool import DescTree, PbModule, TextDataWriter, export_protos, load_pb_module, FIELD_COMMENT_ROW, OUTPUT_FILE_BASE
+from common_def import PROTO_GEN_PATH, PYTHON_GEN_PATH, TEXT_GEN_PATH
+
+class SyntheticSheet:
+    """模拟的页签，接口和xls_pb_tool中的页签读取类一致"""
+
+    def __init__(self, name, columns, rows):
+        # columns是(类型, 名称)的列表
+        self.name = name
+        self._columns = columns
+        self._rows = rows
+
+    def HeaderRows(self):
+        return [[col_type for col_type, _ in self._columns],
+                [col_name for _, col_name in self._columns],
+                [u"注释" + col_name for _, col_name in self._columns]]
+
+    def IterRows(self, begin_row):
+        for row, row_values in enumerate(self._rows, begin_row):
+            yield row, row_values
+
+def gen_tall_sheet(rows, seed = 0):
+    """行数很多的页签：普通字段加上单列分割的数组"""
+    rand = random.Random(seed)
+    columns = [("uint32", "id"), ("string", "name"), ("float", "rate"), ("int64", "score"),
+               ("uint32[repeated]", "drops"), ("float[repeated]", "weights")]
+    data = []
+    for row in range(rows):
+        data.append([float(row + 1), u"名字%d" % rand.randint(0, 1000), rand.random(), float(rand.randint(-10000, 10000)),
+                     ";".join([str(rand.randint(1, 1000)) for _ in range(5)]),
+                     ";".join(["%.2f" % rand.random() for _ in range(5)])])
+    return SyntheticSheet("BENCH_TALL", columns, data)
+
+def gen_wide_sheet(cols, depth, rows, seed = 0):
+    """列数很多的页签：每列是depth层的路径，每层最多fanout个子节点"""
+    rand = random.Random(seed)
+    fanout = max(2, int(round(cols ** (1.0 / (depth + 1)))))
+    columns = [("uint32", "id")]
+    created = set()
+    for col in range(cols):
+        digits = []
+        value = col
+        for _ in range(depth + 1):
+            digits.append(value % fanout)
+            value //= fanout
+        digits.reverse()
+        names = ["s%d" % digit for digit in digits[:-1]] + ["f%d_%d" % (digits[-1], col)]
+        # 新建的结构体要指定类型，类型名全局唯一
+        types = []
+        for level in range(depth):
+            path = ".".join(names[:level + 1])
+            if path not in created:
+                created.add(path)
+                types.append("T_" + path.replace(".", "_"))
+        columns.append(("|".join(types + ["uint32"]), ".".join(names)))
+    data = [[float(row + 1)] + [float(rand.randint(0, 100)) for _ in range(cols)] for row in range(rows)]
+    return SyntheticSheet("BENCH_WIDE", columns, data)
+
+def gen_repeat_sheet(repeat, rows, seed = 0):
+    """结构体数组重复很多次的页签，部分元素为空"""
+    rand = random.Random(seed)
+    columns = [("uint32", "id")]
+    for num in range(repeat):
+        columns.append(("Reward|uint32" if num == 0 else "", "rewards.id"))
+        columns.append(("uint32" if num == 0 else "", "rewards.count"))
+    data = []
+    for row in range(rows):
+        row_values = [float(row + 1)]
+        filled = rand.randint(0, repeat)
+        for num in range(repeat):
+            if num < filled:
+                row_values += [float(rand.randint(1, 10000)), float(rand.randint(1, 99))]
+            else:
+                row_values += [u"", u""]
+        data.append(row_values)
+    return SyntheticSheet("BENCH_REPEAT", columns, data)
+
+def bench_sheet(sheet, in_process):
+    """导出一个页签，返回各阶段耗时(秒)和数据大小"""
+    phases = {}
+    sheet_name = sheet.name
+    pb_file_name = OUTPUT_FILE_BASE + sheet_name.lower() + ".proto"
+
+    begin = timeit.default_timer()
+    DescTree.ClearUsedModules()
+    tree = DescTree(sheet_name.lower(), sheet_name, sheet_name)
+    header_rows = sheet.HeaderRows()
+    for col in range(len(header_rows[0])):
+        tree.AppendNode(header_rows[1][col], header_rows[0][col], header_rows[2][col], col)
+    tree.CheckAndFinish()
+    phases["tree"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    tree.GenProto(pb_file_name)
+    phases["gen_proto"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    if in_process:
+        module = PbModule(tree.GenFileDescriptorProto(pb_file_name))
+    else:
+        export_protos([pb_file_name], True)
+        module = load_pb_module(OUTPUT_FILE_BASE + sheet_name.lower() + "_pb2")
+    phases["protoc_import"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    tree.RecheckFieldDesc(module.DESCRIPTOR.message_types_by_name[sheet_name])
+    phases["compile"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    item_array = getattr(module, sheet_name + "_ARRAY")()
+    for _, row_values in sheet.IterRows(FIELD_COMMENT_ROW + 1):
+        tree.ParseData(item_array.items.add(), row_values)
+    phases["parse"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    data = item_array.SerializeToString()
+    phases["serialize"] = timeit.default_timer() - begin
+
+    begin = timeit.default_timer()
+    text_writer = TextDataWriter(TEXT_GEN_PATH + OUTPUT_FILE_BASE + sheet_name.lower())
+    for item in item_array.items:
+        text_writer.Write(item)
+    text_writer.Close()
+    phases["text"] = timeit.default_timer() - begin
+    return phases, len(data)
+
+def remove_outputs(sheet_name):
+    """删除测试生成的proto、python和文本文件"""
+    file_base = OUTPUT_FILE_BASE + sheet_name.lower()
+    for pathname in [PROTO_GEN_PATH + file_base + ".proto", PYTHON_GEN_PATH + file_base + "_pb2.py", TEXT_GEN_PATH + file_base + ".txt"]:
+        if os.path.isfile(pathname):
+            os.remove(pathname)
+
+def run_bench(sheets, in_process, times):
+    """每个页签跑times次，每个阶段取最小值"""
+    results = []
+    for sheet in sheets:
+        best = {}
+        data_size = 0
+        for _ in range(times):
+            phases, data_size = bench_sheet(sheet, in_process)
+            for phase, cost in phases.items():
+                best[phase] = min(best.get(phase, cost), cost)
+        remove_outputs(sheet.name)
+        header_rows = sheet.HeaderRows()
+        results.append({"case": sheet.name, "cols": len(header_rows[0]), "rows": len(sheet._rows),
+                        "data_bytes": data_size, "phases": best, "total": sum(best.values())})
+        print("%-14s %s" % (sheet.name, " ".join(["%s=%.3f" % (phase, best[phase]) for phase in sorted(best)])))
+    return results
+
+if __name__ == '__main__' :
+    """入口"""
+    import argparse
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--rows", type = int, default = 20000, help = u"tall页签的行数")
+    arg_parser.add_argument("--cols", type = int, default = 1000, help = u"wide页签的列数")
+    arg_parser.add_argument("--depth", type = int, default = 3, help = u"wide页签的路径深度")
+    arg_parser.add_argument("--repeat", type = int, default = 200, help = u"repeat页签中结构体数组的重复次数")
+    arg_parser.add_argument("--small-rows", type = int, default = 1000, help = u"wide和repeat页签的行数")
+    arg_parser.add_argument("--times", type = int, default = 3, help = u"每个页签跑的次数，取最小值")
+    arg_parser.add_argument("--cases", default = "tall,wide,repeat", help = u"要跑的页签，逗号分隔")
+    arg_parser.add_argument("--in-process", action = "store_true", help = u"进程内生成message类，不调用protoc")
+    arg_parser.add_argument("--output", default = "bench_result.json", help = u"结果文件")
+    args = arg_parser.parse_args()
+
+    generators = {
+        "tall": lambda: gen_tall_sheet(args.rows),
+        "wide": lambda: gen_wide_sheet(args.cols, args.depth, args.small_rows),
+        "repeat": lambda: gen_repeat_sheet(args.repeat, args.small_rows),
+    }
+    sheets = [generators[case.strip()]() for case in args.cases.split(",")]
+
+    report = {
+        "python": sys.version.split()[0],
+        "protobuf_impl": xls_pb_tool.protobuf_backend(),
+        "tool_hash": xls_pb_tool.ExportCache.EnvHash(),
+        "in_process": args.in_process,
+        "results": run_bench(sheets, args.in_process, args.times),
+    }
+    result_file = open(args.output, 'wb')
+    result_file.write(json.dumps(report, indent = 4, sort_keys = True, separators = (',', ': ')).encode("utf-8"))
+    result_file.close()
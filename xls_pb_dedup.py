@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+#coding=utf-8
+
+##
+# @file:   xls_pb_dedup.py
+# @brief:  去重数据文件的生成和还原
+#
+# 很多页签里同样的字符串(图标路径、描述)和同样的结构体(奖励)在不同的行里重复出现。
+# 去重文件把重复出现的字符串、结构体序列化后的内容只存一份，放在字典里，item中对应的域换成字典的下标。
+# 文件格式和下面的message一致，所有页签通用：
+#     message DEDUP_DATA {
+#         repeated bytes items = 1;   // 去重后的item
+#         repeated bytes values = 2;  // 字典，重复出现的字符串和结构体序列化后的内容
+#     }
+# 去重后的item中，被换掉的域字段号不变，wire type由2(length-delimited)改成0(varint)，值是字典的下标。
+# 所以item要先用DedupData还原才能解析，还原后的内容和.data中的item完全相同。
+#
+# 用法：
+#     import xls_pb_dedup
+#     from dataconfig_item_conf_pb2 import ITEM_CONF, ITEM_CONF_ARRAY
+#     item_conf = xls_pb_dedup.load_dedup_file("deploy_data/dataconfig_item_conf.dedup", ITEM_CONF)
+#     item = item_conf.Get(0)
+#     item_array = item_conf.ToArray(ITEM_CONF_ARRAY)
+##
+from xls_pb_index import encode_varint, decode_varint, iter_item_spans
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+DEDUP_ITEMS_TAG = encode_varint((1 << 3) | WIRE_LENGTH_DELIMITED)
+DEDUP_VALUES_TAG = encode_varint((2 << 3) | WIRE_LENGTH_DELIMITED)
+
+# 短于这个长度的内容换成下标省不了空间
+MIN_DEDUP_SIZE = 4
+
+def iter_fields(data):
+    """遍历序列化后的message，返回每个域的(字段号, wire type, 开始位置, 内容开始位置, 结束位置)"""
+    pos = 0
+    data_len = len(data)
+    while pos < data_len:
+        begin = pos
+        tag, pos = decode_varint(data, pos)
+        wire_type = tag & 7
+        value_begin = pos
+        if wire_type == WIRE_VARINT:
+            _, pos = decode_varint(data, pos)
+        elif wire_type == WIRE_FIXED64:
+            pos += 8
+        elif wire_type == WIRE_LENGTH_DELIMITED:
+            value_len, value_begin = decode_varint(data, pos)
+            pos = value_begin + value_len
+        elif wire_type == WIRE_FIXED32:
+            pos += 4
+        else:
+            raise Exception("不支持的wire type{0}".format(wire_type))
+        yield tag >> 3, wire_type, begin, value_begin, pos
+
+def is_dedup_field(field_desc):
+    """字符串和结构体可以去重"""
+    return field_desc is not None and field_desc.type in (field_desc.TYPE_STRING, field_desc.TYPE_BYTES, field_desc.TYPE_MESSAGE)
+
+class DedupEncoder:
+    """统计重复出现的内容，生成字典，把item中重复的域换成下标"""
+
+    def __init__(self, item_desc):
+        self._item_desc = item_desc
+        # 内容 -> 出现次数
+        self._counts = {}
+        # 内容 -> 字典下标
+        self._value_index = {}
+        self.values = []
+
+    def Count(self, item_data):
+        """第一遍：统计每个字符串和结构体出现的次数，结构体内部的域也要统计"""
+        self.__count(item_data, self._item_desc)
+
+    def Encode(self, item_data):
+        """第二遍：返回去重后的item。结构体整个重复时换成下标，否则再看内部的域"""
+        return self.__encode(item_data, self._item_desc)
+
+    def __count(self, data, message_desc):
+        counts = self._counts
+        for field_num, wire_type, _, value_begin, end in iter_fields(data):
+            field_desc = message_desc.fields_by_number.get(field_num)
+            if wire_type != WIRE_LENGTH_DELIMITED or not is_dedup_field(field_desc):
+                continue
+            value = data[value_begin:end]
+            if len(value) >= MIN_DEDUP_SIZE:
+                counts[value] = counts.get(value, 0) + 1
+            if field_desc.type == field_desc.TYPE_MESSAGE:
+                self.__count(value, field_desc.message_type)
+
+    def __encode(self, data, message_desc):
+        output = []
+        for field_num, wire_type, begin, value_begin, end in iter_fields(data):
+            field_desc = message_desc.fields_by_number.get(field_num)
+            if wire_type != WIRE_LENGTH_DELIMITED or not is_dedup_field(field_desc):
+                output.append(data[begin:end])
+                continue
+            value = data[value_begin:end]
+            if self._counts.get(value, 0) > 1:
+                # 第一次用到时才放进字典，只在被换掉的结构体里重复的内容不会进字典
+                index = self._value_index.get(value)
+                if index is None:
+                    index = len(self.values)
+                    self._value_index[value] = index
+                    self.values.append(value)
+                output.append(encode_varint((field_num << 3) | WIRE_VARINT))
+                output.append(encode_varint(index))
+            elif field_desc.type == field_desc.TYPE_MESSAGE:
+                value = self.__encode(value, field_desc.message_type)
+                output.append(encode_varint((field_num << 3) | WIRE_LENGTH_DELIMITED))
+                output.append(encode_varint(len(value)))
+                output.append(value)
+            else:
+                output.append(data[begin:end])
+        return b"".join(output)
+
+def write_dedup_file(pathname, item_desc, data):
+    """写去重文件。data是.data文件的内容(可以是mmap)，返回写出的字节数"""
+    # 只有导表工具写文件，服务器读取时不需要
+    from xls_pb_file import write_file_atomic
+    encoder = DedupEncoder(item_desc)
+    spans = list(iter_item_spans(data))
+    for offset, length in spans:
+        encoder.Count(data[offset:offset + length])
+
+    def iter_chunks():
+        # 先逐条写item，字典最后写。解析时不依赖域的顺序
+        for offset, length in spans:
+            item_data = encoder.Encode(data[offset:offset + length])
+            yield DEDUP_ITEMS_TAG + encode_varint(len(item_data))
+            yield item_data
+        for value in encoder.values:
+            yield DEDUP_VALUES_TAG + encode_varint(len(value))
+            yield value
+    return write_file_atomic(pathname, iter_chunks())
+
+class DedupData:
+    """去重后的数据。字典和item都只保留序列化后的内容，用到哪条才还原哪条"""
+
+    def __init__(self, data, item_class):
+        """data是去重文件的内容，item_class是页签对应的message类，如ITEM_CONF"""
+        self._item_class = item_class
+        self._items = []
+        self._values = []
+        for field_num, _, _, value_begin, end in iter_fields(data):
+            if field_num == 1:
+                self._items.append(data[value_begin:end])
+            elif field_num == 2:
+                self._values.append(data[value_begin:end])
+
+    def __len__(self):
+        return len(self._items)
+
+    def GetBytes(self, num):
+        """第num条item还原后序列化的内容，和.data中的item相同"""
+        return self.__expand(self._items[num], self._item_class.DESCRIPTOR)
+
+    def Get(self, num):
+        """解析第num条item"""
+        return self._item_class.FromString(self.GetBytes(num))
+
+    def ToArray(self, array_class):
+        """还原成整个<SHEET>_ARRAY"""
+        items_tag = encode_varint((1 << 3) | WIRE_LENGTH_DELIMITED)
+        output = []
+        for num in range(len(self._items)):
+            item_data = self.GetBytes(num)
+            output += [items_tag, encode_varint(len(item_data)), item_data]
+        return array_class.FromString(b"".join(output))
+
+    def __expand(self, data, message_desc):
+        output = []
+        for field_num, wire_type, begin, value_begin, end in iter_fields(data):
+            field_desc = message_desc.fields_by_number.get(field_num)
+            if not is_dedup_field(field_desc):
+                output.append(data[begin:end])
+            elif wire_type == WIRE_VARINT:
+                # 字典下标，换回原来的内容
+                index, _ = decode_varint(data, value_begin)
+                value = self._values[index]
+                output += [encode_varint((field_num << 3) | WIRE_LENGTH_DELIMITED), encode_varint(len(value)), value]
+            elif field_desc.type == field_desc.TYPE_MESSAGE:
+                value = self.__expand(data[value_begin:end], field_desc.message_type)
+                output += [encode_varint((field_num << 3) | WIRE_LENGTH_DELIMITED), encode_varint(len(value)), value]
+            else:
+                output.append(data[begin:end])
+        return b"".join(output)
+
+def load_dedup_file(pathname, item_class):
+    """读取去重文件"""
+    dedup_file = open(pathname, 'rb')
+    try:
+        return DedupData(dedup_file.read(), item_class)
+    finally:
+        dedup_file.close()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+#coding=utf-8
+
+##
+# @file:   xls_pb_delta.py
+# @brief:  增量数据文件的生成和应用
+#
+# 大表只改了几行时，服务器热更新不用重新加载整个.data，只加载增量文件。
+# 增量文件对比这次和上次导出的.data，按主键(每条数据的第一个字段)列出新增、修改和删除的item。
+# 文件格式和下面的message一致，所有页签通用：
+#     message DELTA_DATA {
+#         repeated bytes added = 1;     // 新增的item
+#         repeated bytes changed = 2;   // 修改过的item，内容是新的
+#         repeated bytes removed = 3;   // 删除的item，只有主键字段
+#         optional string base_md5 = 4; // 上次导出的.data的md5
+#         optional string md5 = 5;      // 这次导出的.data的md5
+#     }
+# item的内容和.data中的item相同。应用前先对比base_md5，确认已加载的就是上次导出的数据。
+# 应用后item的顺序可能和.data不同：修改的item位置不变，新增的item在最后。
+#
+# 用法：
+#     import xls_pb_delta
+#     from dataconfig_item_conf_pb2 import ITEM_CONF
+#     delta = xls_pb_delta.load_delta_file("deploy_data/dataconfig_item_conf.delta", ITEM_CONF)
+#     if delta.base_md5 == loaded_md5:
+#         delta.Apply(item_array)
+##
+import hashlib
+from xls_pb_index import encode_varint, iter_item_spans
+from xls_pb_dedup import iter_fields, WIRE_LENGTH_DELIMITED
+
+DELTA_ADDED = 1
+DELTA_CHANGED = 2
+DELTA_REMOVED = 3
+DELTA_BASE_MD5 = 4
+DELTA_MD5 = 5
+
+def item_keys(data, key_field_num):
+    """遍历.data的内容，返回每个item的(主键字段序列化后的内容, 偏移, 长度)。没有主键字段时主键为空"""
+    for offset, length in iter_item_spans(data):
+        key = b""
+        item_data = data[offset:offset + length]
+        for field_num, _, begin, _, end in iter_fields(item_data):
+            if field_num == key_field_num:
+                key = item_data[begin:end]
+                break
+        yield key, offset, length
+
+def index_items(data, key_field_num):
+    """返回按顺序的[(主键, 偏移, 长度)]和主键 -> (偏移, 长度)。主键重复时报错"""
+    items = list(item_keys(data, key_field_num))
+    spans = dict([(key, (offset, length)) for key, offset, length in items])
+    if len(spans) != len(items):
+        raise Exception("主键有重复，不能生成增量，加--validate可以看到重复的行")
+    return items, spans
+
+def encode_field(field_num, value):
+    return encode_varint((field_num << 3) | WIRE_LENGTH_DELIMITED) + encode_varint(len(value)) + value
+
+def write_delta_file(pathname, key_field_num, old_data, new_data):
+    """对比上次和这次导出的.data内容写增量文件。key_field_num是主键的字段号。返回写出的字节数"""
+    # 只有导表工具写文件，服务器读取时不需要
+    from xls_pb_file import write_file_atomic
+    old_items, old_spans = index_items(old_data, key_field_num)
+    new_items, new_spans = index_items(new_data, key_field_num)
+    added = []
+    changed = []
+    for key, offset, length in new_items:
+        item_data = new_data[offset:offset + length]
+        old_span = old_spans.get(key)
+        if old_span is None:
+            added.append(encode_field(DELTA_ADDED, item_data))
+        elif old_data[old_span[0]:old_span[0] + old_span[1]] != item_data:
+            changed.append(encode_field(DELTA_CHANGED, item_data))
+    # 主键字段单独序列化就是一个只有主键的item
+    removed = [encode_field(DELTA_REMOVED, key) for key, _, _ in old_items if key not in new_spans]
+    md5s = [encode_field(DELTA_BASE_MD5, hashlib.md5(old_data).hexdigest().encode("ascii")),
+            encode_field(DELTA_MD5, hashlib.md5(new_data).hexdigest().encode("ascii"))]
+    return write_file_atomic(pathname, added + changed + removed + md5s)
+
+class DeltaData:
+    """增量数据。新增、修改的item和删除的主键都只保留序列化后的内容，用到时才解析"""
+
+    def __init__(self, data, item_class):
+        """data是增量文件的内容，item_class是页签对应的message类，如ITEM_CONF"""
+        self._item_class = item_class
+        self._key_name = item_class.DESCRIPTOR.fields[0].name
+        self._added = []
+        self._changed = []
+        self._removed = []
+        self.base_md5 = None
+        self.md5 = None
+        for field_num, _, _, value_begin, end in iter_fields(data):
+            value = data[value_begin:end]
+            if field_num == DELTA_ADDED:
+                self._added.append(value)
+            elif field_num == DELTA_CHANGED:
+                self._changed.append(value)
+            elif field_num == DELTA_REMOVED:
+                self._removed.append(value)
+            elif field_num == DELTA_BASE_MD5:
+                self.base_md5 = value.decode("ascii")
+            elif field_num == DELTA_MD5:
+                self.md5 = value.decode("ascii")
+
+    def __len__(self):
+        return len(self._added) + len(self._changed) + len(self._removed)
+
+    def Added(self):
+        """新增的item"""
+        return [self._item_class.FromString(item_data) for item_data in self._added]
+
+    def Changed(self):
+        """修改过的item"""
+        return [self._item_class.FromString(item_data) for item_data in self._changed]
+
+    def RemovedKeys(self):
+        """删除的item的主键"""
+        return [self.__key(key_data) for key_data in self._removed]
+
+    def Apply(self, item_array):
+        """把增量应用到已加载的<SHEET>_ARRAY上。修改的item原地替换，删除的item去掉，新增的item加在最后。
+        增量和已加载的数据对不上时报错，这时item_array可能已经改了一部分，应该重新加载整个.data"""
+        items = item_array.items
+        positions = dict([(getattr(item, self._key_name), num) for num, item in enumerate(items)])
+        for item_data in self._changed:
+            key = self.__key(item_data)
+            if key not in positions:
+                raise Exception("修改的主键{0}不存在，增量和已加载的数据不一致".format(key))
+            items[positions[key]].ParseFromString(item_data)
+        removed_nums = []
+        for key in self.RemovedKeys():
+            if key not in positions:
+                raise Exception("删除的主键{0}不存在，增量和已加载的数据不一致".format(key))
+            removed_nums.append(positions.pop(key))
+        for num in sorted(removed_nums, reverse = True):
+            del items[num]
+        for item_data in self._added:
+            key = self.__key(item_data)
+            if key in positions:
+                raise Exception("新增的主键{0}已存在，增量和已加载的数据不一致".format(key))
+            items.add().ParseFromString(item_data)
+
+    def __key(self, item_data):
+        return getattr(self._item_class.FromString(item_data), self._key_name)
+
+def load_delta_file(pathname, item_class):
+    """读取增量文件"""
+    delta_file = open(pathname, 'rb')
+    try:
+        return DeltaData(delta_file.read(), item_class)
+    finally:
+        delta_file.close()
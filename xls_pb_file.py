@@ -0,0 +1,33 @@
+#! /usr/bin/env python3
+#coding=utf-8
+
+##
+# @file:   xls_pb_file.py
+# @brief:  导表工具写文件的公共函数
+#
+# 导表工具和索引、去重、增量文件的生成都用这里的函数写文件。
+# 服务器只读取这些文件，不需要这个模块。
+##
+import os
+
+def rename_file(src, dst):
+    """覆盖式改名。windows下rename不能覆盖已存在的文件"""
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def write_file_atomic(pathname, content):
+    """先写临时文件再改名，导出中断时不会留下写了一半的文件。
+    content是bytes，或者逐段返回bytes的迭代器，大文件不用先拼起来。返回写出的字节数"""
+    chunks = [content] if isinstance(content, bytes) else content
+    tmp_pathname = pathname + ".tmp"
+    tmp_file = open(tmp_pathname, 'wb')
+    size = 0
+    try:
+        for chunk in chunks:
+            tmp_file.write(chunk)
+            size += len(chunk)
+    finally:
+        tmp_file.close()
+    rename_file(tmp_pathname, pathname)
+    return size
@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+#coding=utf-8
+
+##
+# @file:   xls_pb_index.py
+# @brief:  带索引的数据文件的格式和读取
+#
+# 文件格式(小端)：
+#     文件头     magic(8字节) 主键类型(uint32) 条数(uint32) 数据偏移(uint64) 数据长度(uint64) 索引偏移(uint64)
+#     数据       和.data文件完全相同，即整个<SHEET>_ARRAY序列化后的内容
+#     索引       按主键排序的定长索引项，字符串主键的内容跟在索引项后面
+# 主键是每条数据的第一个字段。读取时mmap整个文件，按主键二分查找，只解析用到的那一条，
+# 服务器启动和热更新时不用解析整张表。
+#
+# 用法：
+#     import xls_pb_index
+#     from dataconfig_item_conf_pb2 import ITEM_CONF
+#     item_conf = xls_pb_index.IndexedData("deploy_data/dataconfig_item_conf.idx", ITEM_CONF)
+#     item = item_conf.Get(1001)
+##
+import mmap
+import struct
+
+INDEX_MAGIC = b"XPBIDX01"
+INDEX_HEADER = struct.Struct("<8sIIQQQ")
+
+# 主键类型
+KEY_INT64 = 1
+KEY_UINT64 = 2
+KEY_STRING = 3
+
+# 索引项。数字主键：(主键, 数据偏移, 数据长度)；字符串主键：(主键偏移, 主键长度, 数据偏移, 数据长度)
+INDEX_ENTRIES = {
+    KEY_INT64: struct.Struct("<qQQ"),
+    KEY_UINT64: struct.Struct("<QQQ"),
+    KEY_STRING: struct.Struct("<QQQQ"),
+}
+
+# 写数据时每次拷贝的字节数
+COPY_CHUNK_SIZE = 1 << 20
+
+def encode_varint(value):
+    """protobuf的varint编码"""
+    buf = bytearray()
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+    return bytes(buf)
+
+def decode_varint(data, pos):
+    """protobuf的varint解码，返回(值, 下一个位置)"""
+    value = 0
+    shift = 0
+    for byte in data[pos:pos + 10]:
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+    raise Exception("数据格式错误，varint没有结束")
+
+def iter_item_spans(data):
+    """遍历<SHEET>_ARRAY序列化后的内容，返回每个item的(偏移, 长度)。每个item是items字段的tag+长度+内容"""
+    pos = 0
+    data_len = len(data)
+    while pos < data_len:
+        _, pos = decode_varint(data, pos)
+        item_len, pos = decode_varint(data, pos)
+        yield pos, item_len
+        pos += item_len
+
+def encode_key(key_type, key):
+    """字符串主键统一按utf-8比较"""
+    if key_type == KEY_STRING and isinstance(key, str):
+        return key.encode("utf-8")
+    return key
+
+def write_index_file(pathname, key_type, keys, data):
+    """写带索引的数据文件。keys是每个item的主键，data是.data文件的内容(可以是mmap)。主键重复时报错"""
+    # 只有导表工具写文件，服务器读取时不需要
+    from xls_pb_file import write_file_atomic
+    entries = sorted([(encode_key(key_type, key), offset, length) for key, (offset, length) in zip(keys, iter_item_spans(data))])
+    if len(entries) != len(keys):
+        raise Exception("数据有{0}条，主键有{1}个，不一致".format(len(entries), len(keys)))
+    for prev_entry, entry in zip(entries, entries[1:]):
+        if prev_entry[0] == entry[0]:
+            raise Exception("主键{0}重复，不能建索引".format(repr(entry[0])))
+
+    entry_struct = INDEX_ENTRIES[key_type]
+    data_offset = INDEX_HEADER.size
+    index_offset = data_offset + len(data)
+    def iter_chunks():
+        yield INDEX_HEADER.pack(INDEX_MAGIC, key_type, len(entries), data_offset, len(data), index_offset)
+        for pos in range(0, len(data), COPY_CHUNK_SIZE):
+            yield data[pos:pos + COPY_CHUNK_SIZE]
+        if key_type == KEY_STRING:
+            key_offset = index_offset + entry_struct.size * len(entries)
+            for key, offset, length in entries:
+                yield entry_struct.pack(key_offset, len(key), data_offset + offset, length)
+                key_offset += len(key)
+            for key, _, _ in entries:
+                yield key
+        else:
+            for key, offset, length in entries:
+                yield entry_struct.pack(key, data_offset + offset, length)
+    return write_file_atomic(pathname, iter_chunks())
+
+class IndexedData:
+    """mmap方式读取带索引的数据文件，按主键解析单条数据，解析过的会缓存"""
+
+    def __init__(self, pathname, item_class):
+        """item_class是页签对应的message类，如ITEM_CONF"""
+        self._item_class = item_class
+        self._file = open(pathname, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self._key_type, self._count, self._data_offset, self._data_len, self._index_offset = INDEX_HEADER.unpack_from(self._mmap, 0)
+        if magic != INDEX_MAGIC or self._key_type not in INDEX_ENTRIES:
+            self.Close()
+            raise Exception("{0}不是索引数据文件".format(pathname))
+        self._entry_struct = INDEX_ENTRIES[self._key_type]
+        # 主键 -> 解析好的item
+        self._items = {}
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self.__find(encode_key(self._key_type, key)) is not None
+
+    def Get(self, key, default = None):
+        """按主键取一条数据，找不到时返回default"""
+        key = encode_key(self._key_type, key)
+        item = self._items.get(key)
+        if item is None:
+            item_data = self.GetBytes(key)
+            if item_data is None:
+                return default
+            item = self._item_class.FromString(item_data)
+            self._items[key] = item
+        return item
+
+    def GetBytes(self, key):
+        """按主键取一条数据序列化后的内容，不解析"""
+        entry = self.__find(encode_key(self._key_type, key))
+        if entry is None:
+            return None
+        offset, length = entry[-2:]
+        return self._mmap[offset:offset + length]
+
+    def Keys(self):
+        """按顺序返回所有主键"""
+        keys = [self.__key_at(num) for num in range(self._count)]
+        if self._key_type == KEY_STRING:
+            return [key.decode("utf-8") for key in keys]
+        return keys
+
+    def Items(self):
+        """按主键顺序返回所有(主键, item)"""
+        return [(key, self.Get(key)) for key in self.Keys()]
+
+    def DataBytes(self):
+        """整个<SHEET>_ARRAY序列化后的内容，和.data文件相同"""
+        return self._mmap[self._data_offset:self._data_offset + self._data_len]
+
+    def Close(self):
+        self._items = {}
+        self._mmap.close()
+        self._file.close()
+
+    def __entry(self, num):
+        return self._entry_struct.unpack_from(self._mmap, self._index_offset + self._entry_struct.size * num)
+
+    def __key_at(self, num):
+        entry = self.__entry(num)
+        if self._key_type == KEY_STRING:
+            return self._mmap[entry[0]:entry[0] + entry[1]]
+        return entry[0]
+
+    def __find(self, key):
+        """二分查找主键，返回索引项"""
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            mid_key = self.__key_at(mid)
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                return self.__entry(mid)
+        return None
@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 #coding=utf-8
 
 ##
@@ -16,18 +16,25 @@
 # 读取excel的每一列，根据路径就可以重建这棵树。
 #
 # 依赖:
-# 1 protobuf
-# 2 xlrd
+# 1 python3
+# 2 protobuf(3.x以上，4.21以上自带upb实现，比纯python实现快很多)
+# 3 xlrd
+# 4 openpyxl(可选，流式读取xlsx)
+# 5 numpy(可选，列式转换数字数组)
 ##
 import sys
 import json
 import os
+import re
+import time
 import traceback
 import xlrd
-
-# utf-8编码方式
-reload(sys)
-sys.setdefaultencoding( "utf-8" )
+import xls_pb_index
+import xls_pb_dedup
+import xls_pb_delta
+import xls_pb_file
+from xls_pb_index import encode_varint
+from xls_pb_file import write_file_atomic, rename_file
 
 # 创建文件夹
 def create_path_if_noexist(pathname):
@@ -46,16 +53,119 @@ def create_path_if_noexist(pathname):
 from common_def import *
 sys.path.append(PB_PYTHON)
 
-# 本地python路径 
+# 本地python路径。要在第一次import之前创建，否则python会缓存该路径不存在，后续生成的模块都import不到
+create_path_if_noexist(PYTHON_GEN_PATH)
 sys.path.append(PYTHON_GEN_PATH) 
 
-# 加载公共库
+# 公共库的路径。公共库只在页签用到其中的类型时才加载
 sys.path.append(CUSTOM_PYTHON)
-comm_loaded_modules = map(__import__, COMMON_MODULES)
+
+# 公共库中的类型索引，按模块文件的修改时间和大小判断是否需要更新
+COMMON_TYPES_CACHE_FILE = os.path.normpath(PYTHON_GEN_PATH) + ".common_types.json"
+
+class CommonModules:
+    """公共模块。类型名 -> 模块名的索引第一次查找时才建立，并缓存到文件里，模块没变时不用import就能知道类型在哪个模块中。
+    模块只在页签用到其中的类型时才import"""
+
+    def __init__(self, module_names, cache_file):
+        self._module_names = module_names
+        self._cache_file = cache_file
+        # 类型名 -> 模块名，message和enum分开
+        self._type_index = None
+        self._enum_index = None
+        # 已经import的模块
+        self._loaded_modules = {}
+
+    def FindType(self, type_name):
+        """查找公共类型的描述，找不到返回None。多个模块中都有时用排在前面的模块"""
+        if self._type_index is None:
+            self._type_index, self._enum_index = self.__build_index()
+        module_name = self._type_index.get(type_name)
+        if module_name is None:
+            return None
+        return self.__import(module_name).DESCRIPTOR.message_types_by_name[type_name]
+
+    def FindEnum(self, type_name):
+        """查找公共模块中定义的enum，找不到返回None"""
+        if self._enum_index is None:
+            self._type_index, self._enum_index = self.__build_index()
+        module_name = self._enum_index.get(type_name)
+        if module_name is None:
+            return None
+        return self.__import(module_name).DESCRIPTOR.enum_types_by_name[type_name]
+
+    def FindFile(self, file_name):
+        """按proto文件名查找公共模块的文件描述，找不到返回None。先按protoc的命名规则猜模块名，猜不到再逐个import"""
+        guess_name = file_name[:-len(".proto")].replace("/", ".") + "_pb2"
+        module_names = [guess_name] if guess_name in self._module_names else []
+        module_names += [module_name for module_name in self._module_names if module_name != guess_name]
+        for module_name in module_names:
+            module = self.__import(module_name)
+            if module.DESCRIPTOR.name == file_name:
+                return module.DESCRIPTOR
+        return None
+
+    def ModuleFiles(self):
+        """所有模块的源文件，找不到的不包括在内"""
+        return [module_file for module_file in map(CommonModules.__find_module_file, self._module_names) if module_file]
+
+    def __import(self, module_name):
+        if module_name not in self._loaded_modules:
+            self._loaded_modules[module_name] = __import__(module_name)
+        return self._loaded_modules[module_name]
+
+    def __build_index(self):
+        """读缓存，只有修改过的模块才import，重新列出其中的类型"""
+        cached_modules = {}
+        if os.path.isfile(self._cache_file):
+            try:
+                cached_modules = json.load(open(self._cache_file, 'rb'))
+            except ValueError:
+                cached_modules = {}
+        modules = {}
+        type_index = {}
+        enum_index = {}
+        for module_name in self._module_names:
+            module_file = CommonModules.__find_module_file(module_name)
+            stamp = None
+            if module_file:
+                stat = os.stat(module_file)
+                stamp = [stat.st_mtime, stat.st_size]
+            cached = cached_modules.get(module_name)
+            if stamp and cached and cached["stamp"] == stamp and "enums" in cached:
+                type_names = cached["types"]
+                enum_names = cached["enums"]
+            else:
+                file_desc = self.__import(module_name).DESCRIPTOR
+                type_names = sorted(file_desc.message_types_by_name)
+                enum_names = sorted(file_desc.enum_types_by_name)
+            modules[module_name] = {"stamp": stamp, "types": type_names, "enums": enum_names}
+            for type_name in type_names:
+                type_index.setdefault(type_name, module_name)
+            for enum_name in enum_names:
+                enum_index.setdefault(enum_name, module_name)
+        if modules != cached_modules:
+            try:
+                write_file_atomic(self._cache_file, json.dumps(modules, indent = 4, sort_keys = True, separators = (',', ': ')).encode("utf-8"))
+            except (IOError, OSError):
+                # 缓存写不了不影响导出
+                pass
+        return type_index, enum_index
+
+    @staticmethod
+    def __find_module_file(module_name):
+        """不import，在sys.path中找到模块的源文件"""
+        for path in sys.path:
+            module_file = os.path.join(path, module_name.replace('.', os.sep) + ".py")
+            if os.path.isfile(module_file):
+                return module_file
+        return None
+
+common_modules = CommonModules(COMMON_MODULES, COMMON_TYPES_CACHE_FILE)
 
 def decimal2az(n):
     """将十进制转换为26进制a-z"""
-    return (decimal2az(n/26-1) if n/26>0 else '') + chr(65 + n%26)
+    return (decimal2az(n//26-1) if n//26>0 else '') + chr(65 + n%26)
 
 #########################protobuf cpp_type##########################################
 #CPPTYPE_INT32       = 1,     // TYPE_INT32, TYPE_SINT32, TYPE_SFIXED32
@@ -69,13 +179,206 @@ def decimal2az(n):
 #CPPTYPE_STRING      = 9,     // TYPE_STRING, TYPE_BYTES
 #CPPTYPE_MESSAGE     = 10,    // TYPE_MESSAGE, TYPE_GROUP
 ##############################################################################
+# proto中的标量类型对应FieldDescriptorProto.Type
+SCALAR_FIELD_TYPES = {
+    "double": 1, "float": 2, "int64": 3, "uint64": 4, "int32": 5, "fixed64": 6, "fixed32": 7, "bool": 8,
+    "string": 9, "bytes": 12, "uint32": 13, "sfixed32": 15, "sfixed64": 16, "sint32": 17, "sint64": 18,
+}
+# FieldDescriptorProto.Type中的message和enum
+TYPE_MESSAGE = 11
+TYPE_ENUM = 14
+# FieldDescriptorProto.Label
+LABEL_OPTIONAL = 1
+LABEL_REPEATED = 3
+
+def is_repeated_field(field_desc):
+    """域是否是数组。新版本protobuf的FieldDescriptor去掉了label，改用is_repeated"""
+    if hasattr(field_desc, "is_repeated"):
+        return field_desc.is_repeated
+    return field_desc.label == LABEL_REPEATED
+
+# 生成的proto的package
+PB_PACKAGE = "op.pb"
+
+# 整数类型，包括bool和enum
+INT_CPP_TYPES = frozenset([1, 2, 3, 4, 7, 8])
+# 浮点类型
+FLOAT_CPP_TYPES = frozenset([5, 6])
+
+class CellValueError(Exception):
+    """单元格内容错误。row是excel中的行号，解析到具体行时才填"""
+
+    def __init__(self, col, cell_value, row = None):
+        Exception.__init__(self)
+        self.col = col
+        self.cell_value = cell_value
+        self.row = row
+
+    def __reduce__(self):
+        # 行并行解析时从工作进程传回
+        return (CellValueError, (self.col, self.cell_value, self.row))
+
+    def __str__(self):
+        position = decimal2az(self.col) if self.row is None else "{0}{1}".format(decimal2az(self.col), self.row + 1)
+        return "单元格({0})内容错误({1})，请检查".format(position, self.cell_value)
+
+class LruCache(object):
+    """有容量上限的LRU缓存"""
+
+    def __init__(self, capacity):
+        from collections import OrderedDict
+        self._capacity = capacity
+        self._values = OrderedDict()
+
+    def Get(self, key):
+        """没有缓存时返回None"""
+        value = self._values.pop(key, None)
+        if value is not None:
+            # 放到最后，表示最近用过
+            self._values[key] = value
+        return value
+
+    def Put(self, key, value):
+        if len(self._values) >= self._capacity:
+            self._values.popitem(last = False)
+        self._values[key] = value
+
+# 时间格式
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# 时间转换的缓存大小，同一个时间在日程、活动表里会重复很多次
+TIME_CACHE_SIZE = 65536
+DATE_TIME_CACHE = LruCache(TIME_CACHE_SIZE)
+HOUR_TIME_CACHE = LruCache(TIME_CACHE_SIZE)
+# HourTime以这一天为基准计算秒数
+HOUR_TIME_BASE = "2000-01-01 "
+HOUR_TIME_BASE_STAMP = int(time.mktime(time.strptime(HOUR_TIME_BASE + "00:00:00", TIME_FORMAT)))
+
+def parse_date_time(cell_value):
+    """DateTime：'2020-01-01 10:00:00'转换为时间戳"""
+    value = DATE_TIME_CACHE.Get(cell_value)
+    if value is None:
+        value = int(time.mktime(time.strptime(cell_value, TIME_FORMAT)))
+        DATE_TIME_CACHE.Put(cell_value, value)
+    return value
+
+def parse_hour_time(cell_value):
+    """HourTime：'01:30:00'转换为一天中的秒数"""
+    value = HOUR_TIME_CACHE.Get(cell_value)
+    if value is None:
+        value = int(time.mktime(time.strptime(HOUR_TIME_BASE + cell_value, TIME_FORMAT))) - HOUR_TIME_BASE_STAMP
+        HOUR_TIME_CACHE.Put(cell_value, value)
+    return value
+
+def is_blank_cell(cell_value):
+    """空单元格。xlrd中空单元格是空串，数字都是float"""
+    return isinstance(cell_value, str) and cell_value.strip() == ""
+
+def convert_column(convert, cell_values):
+    """整列转换，同样的值只转换一次"""
+    converted = {}
+    result = []
+    for cell_value in cell_values:
+        if cell_value not in converted:
+            converted[cell_value] = convert(cell_value)
+        result.append(converted[cell_value])
+    return result
+
+class PackedValues(list):
+    """列式转换好的';'分割数组，解码时直接extend"""
+    pass
+
+class ConvertedTime(int):
+    """列式转换好的DateTime、HourTime，解码时直接用"""
+    pass
+
+def convert_time_column(convert, cell_values):
+    """把一整列DateTime、HourTime转换成ConvertedTime，同样的时间只转换一次，空单元格为None"""
+    return [None if value is None else ConvertedTime(value) for value in convert_column(convert, cell_values)]
+
+# 整数类型的取值范围，列式转换时校验
+INT_CPP_TYPE_RANGES = {1: (-2 ** 31, 2 ** 31 - 1), 2: (-2 ** 63, 2 ** 63 - 1), 3: (0, 2 ** 32 - 1), 4: (0, 2 ** 64 - 1)}
+
+def convert_packed_column(col, cpp_type, cell_values):
+    """把一整列';'分割的数字转换成每行的PackedValues，空单元格为None。
+    安装了numpy时整列一次转换，结果和逐行转换完全一致；numpy无法保证一致时(溢出、格式错误等)按行转换并报告错误的单元格"""
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        result = _convert_packed_column_numpy(numpy, cpp_type, cell_values)
+        if result is not None:
+            return result
+
+    is_int = cpp_type in INT_CPP_TYPES
+    value_range = INT_CPP_TYPE_RANGES.get(cpp_type)
+    def convert_cell(cell_value):
+        if is_blank_cell(cell_value):
+            return None
+        try:
+            if is_int:
+                values = PackedValues([int(float(x)) for x in str(cell_value).split(';')])
+            else:
+                values = PackedValues([float(x) for x in str(cell_value).split(';')])
+        except (ValueError, OverflowError):
+            raise CellValueError(col, cell_value) from None
+        if value_range and (min(values) < value_range[0] or max(values) > value_range[1]):
+            raise CellValueError(col, cell_value)
+        return values
+    return convert_column(convert_cell, cell_values)
+
+def _convert_packed_column_numpy(numpy, cpp_type, cell_values):
+    """numpy整列转换，不能保证和逐行转换一致时返回None"""
+    tokens = []
+    counts = []
+    for cell_value in cell_values:
+        if is_blank_cell(cell_value):
+            counts.append(-1)
+            continue
+        parts = str(cell_value).split(';')
+        tokens.extend(parts)
+        counts.append(len(parts))
+    try:
+        values = numpy.array(tokens, dtype = numpy.float64)
+    except ValueError:
+        return None
+    if cpp_type in INT_CPP_TYPES:
+        if not numpy.isfinite(values).all():
+            return None
+        values = numpy.trunc(values)
+        # 超过int64的值交给python处理
+        if len(values) and numpy.abs(values).max() >= 2.0 ** 63:
+            return None
+        values = values.astype(numpy.int64)
+        value_range = INT_CPP_TYPE_RANGES.get(cpp_type)
+        if value_range and len(values) and (values.min() < value_range[0] or values.max() > value_range[1]):
+            return None
+    flat_values = values.tolist()
+    result = []
+    pos = 0
+    for count in counts:
+        if count < 0:
+            result.append(None)
+        else:
+            result.append(PackedValues(flat_values[pos:pos + count]))
+            pos += count
+    return result
+
+# 类型中的特性和默认值分隔符，如uint32[DateTime]=0
+TYPE_SPLIT_RE = re.compile(r'[\[\]\=]')
+
 # 描述树
-class DescTree:
+class DescTree(object):
     """描述树的节点"""
+    __slots__ = ["_name", "_type", "_default", "_is_repeated", "_is_date", "_is_hour", "_nokey", "_not_repeated",
+                 "_is_index", "_value_range", "_ref_sheet", "_comment", "_is_common_type", "_repeated_count", "_sub_nodes", "_sub_node_index", "_parent", "_depth",
+                 "_pb_desc", "_field_desc", "_order_number", "_col_array", "_decode_plan", "_counters"]
     # 最近遍历过的叶节点
     __last_leaf_node = None
     # 用到的公共模块
     __used_modules = set()
+    # 类型字符串的分割结果
+    __split_type_cache = {}
 
     def __init__(self, name, type_name, comment, pb_desc = None):
             """构造节点时指定名称"""
@@ -90,6 +393,8 @@ class DescTree:
             self._repeated_count = 1
             # 子节点
             self._sub_nodes = []
+            # 子节点名称索引
+            self._sub_node_index = {}
             # 父节点
             self._parent = None
             # 当前节点的深度
@@ -102,6 +407,10 @@ class DescTree:
             self._order_number = 0
             # 对应的列号
             self._col_array = []
+            # 解码计划
+            self._decode_plan = None
+            # 解码时的计数，只在根节点上
+            self._counters = None
 
     def __str__(self):
         node_str = self._name
@@ -121,38 +430,45 @@ class DescTree:
             if str_node_name == "":
                 return
             # 分割名称
-            node_name_list = str_node_name.split('.', 1)
-            # 分割类型, 由于类型可以省略所以暂时不pop
-            type_name_list = str_type_name.split('|', 1)
-            # 查找节点
-            node = self.__get_node_by_name(node_name_list[0])
-            # 未找到节点，插入新节点
-            if node == None:
-                if not self._is_common_type and type_name_list[0] == "":
-                    raise Exception(node_name_list[0] + u"不是公共类型，但又没有指定类型名称. 列：" + decimal2az(col))
-                node = self.__create_subnode(node_name_list[0], type_name_list[0], str_comment, len(node_name_list) == 1)
-                type_name_list.pop(0)
-            else:
-                # 和当前类型匹配，删除类型名
-                real_type_name, _, _ = self.__split_type(type_name_list[0])
-                if node._type == real_type_name:
+            node_name_list = str_node_name.split('.')
+            # a.、a..b、.a这样的名称会生成没有名字的域
+            if "" in node_name_list:
+                raise Exception("第{0}列，名称{1}中'.'的前后不能为空".format(decimal2az(col), str_node_name))
+            parent = self
+            for depth, node_name in enumerate(node_name_list):
+                is_leaf = depth + 1 == len(node_name_list)
+                # 分割类型, 由于类型可以省略所以暂时不pop
+                type_name_list = str_type_name.split('|', 1)
+                # 查找节点
+                node = parent._sub_node_index.get(node_name)
+                # 未找到节点，插入新节点
+                if node is None:
+                    if not parent._is_common_type and type_name_list[0] == "":
+                        raise Exception(node_name + u"不是公共类型，但又没有指定类型名称. 列：" + decimal2az(col))
+                    node = parent.__create_subnode(node_name, type_name_list[0], str_comment, is_leaf)
                     type_name_list.pop(0)
-                # 结构体是否是repeat只看第一个字段是否重复
-                if len(node_name_list) == 1 and node._parent._sub_nodes[0] == node:
-                    subnode = node
-                    while subnode._parent:
-                        if not subnode._not_repeated and subnode._parent._sub_nodes[-1] == subnode:
-                            break
-                        subnode = subnode._parent
-                    subnode._repeated_count += 1
-            # 非叶节点，则继续递归遍历
-            if len(node_name_list) > 1:
-                node.AppendNode(node_name_list[1], '|'.join(type_name_list), str_comment, col)
-            else:
-                # 如果到了叶节点，但是类型还没用完，表明中间出错了
-                if len(type_name_list) != 0 and type_name_list[0] != "":
-                    raise Exception("第{0}列，{1}是叶节点，但类型{2}还有剩余。".format(decimal2az(col), node._name, '.'.join(type_name_list)))
-                node._col_array.append(col)
+                else:
+                    # 和当前类型匹配，删除类型名
+                    real_type_name, _, _ = DescTree.__split_type(type_name_list[0])
+                    if node._type == real_type_name:
+                        type_name_list.pop(0)
+                    # 结构体是否是repeat只看第一个字段是否重复
+                    if is_leaf and parent._sub_nodes[0] is node:
+                        subnode = node
+                        while subnode._parent:
+                            if not subnode._not_repeated and subnode._parent._sub_nodes[-1] is subnode:
+                                break
+                            subnode = subnode._parent
+                        subnode._repeated_count += 1
+                # 非叶节点，则继续往下找
+                if not is_leaf:
+                    str_type_name = '|'.join(type_name_list)
+                    parent = node
+                else:
+                    # 如果到了叶节点，但是类型还没用完，表明中间出错了
+                    if len(type_name_list) != 0 and type_name_list[0] != "":
+                        raise Exception("第{0}列，{1}是叶节点，但类型{2}还有剩余。".format(decimal2az(col), node._name, '.'.join(type_name_list)))
+                    node._col_array.append(col)
 
     def CheckAndFinish(self):
         if self.__is_message():
@@ -167,6 +483,53 @@ class DescTree:
                 if node.__is_message():
                     node.CheckAndFinish()
 
+    def PackedNumericColumns(self):
+        """';'分割的数字数组对应的所有列，返回[(列号, cpp_type)]"""
+        columns = []
+        for node in self._sub_nodes:
+            if node.__is_message():
+                columns += node.PackedNumericColumns()
+            elif node._is_repeated and node._repeated_count == 1:
+                cpp_type = node._field_desc.cpp_type
+                if cpp_type in INT_CPP_TYPES or cpp_type in FLOAT_CPP_TYPES:
+                    columns += [(col, cpp_type) for col in node._col_array]
+        return columns
+
+    def TimeColumns(self):
+        """DateTime、HourTime对应的所有列，返回[(列号, 单元格转换函数)]。';'分割的数组不支持时间，不包括在内"""
+        columns = []
+        for node in self._sub_nodes:
+            if node.__is_message():
+                columns += node.TimeColumns()
+            elif (node._is_date or node._is_hour) and node._field_desc.cpp_type in INT_CPP_TYPES and \
+                    not (node._is_repeated and node._repeated_count == 1):
+                columns += [(col, node.__make_converter(col)) for col in node._col_array]
+        return columns
+
+    def ValidationRules(self, path = ()):
+        """校验规则[(域路径, 数值范围, 引用的页签, 默认值)]，域路径是[(域名, 是否数组)]"""
+        rules = []
+        for node in self._sub_nodes:
+            node_path = path + ((node._name, is_repeated_field(node._field_desc)),)
+            if node.__is_message():
+                rules += node.ValidationRules(node_path)
+            elif node._value_range or node._ref_sheet:
+                rules.append((node_path, node._value_range, node._ref_sheet, node._field_desc.default_value))
+        return rules
+
+    def KeyFieldDesc(self):
+        """主键，即第一个字段的域描述"""
+        return self._sub_nodes[0]._field_desc
+
+    def Counters(self):
+        """解码时的计数"""
+        return self._counters
+
+    def ResetCounters(self):
+        """重新导出前清零。解码计划中引用了这个dict，只能原地修改"""
+        for counter_name in self._counters:
+            self._counters[counter_name] = 0
+
     def Dump(self, tab_num = 0):
         print("    " * tab_num + str(self))
         tab_num += 1
@@ -181,16 +544,136 @@ class DescTree:
         output += "* @brief:  这个文件是通过工具自动生成的，不要手动修改\n"
         output += "*/\n\n"
         output += DescTree.gen_comm_module() + "\n"
-        output += "package op.pb;\n\n"
-        output += self.__gen_node_desc()
+        output += "package " + PB_PACKAGE + ";\n\n"
+        output += self.__gen_node_desc(0, {})
         output += "\nmessage {self._type}_ARRAY {{\n    repeated {self._type} items = 1;\n}}".format(**vars())
 
         # 写pb文件
         pb_full_path = PROTO_GEN_PATH + pb_file_name
         pb_file = open(pb_full_path, 'wb+')
-        pb_file.write(output)
+        pb_file.write(output.encode("utf-8"))
         pb_file.close()
 
+    def GenLoader(self, loader_file_name, py_module_name):
+        """生成加载数据的python模块：按主键取一条数据，按index特性的字段查找所有数据。索引第一次用到时才建立"""
+        key_node = self._sub_nodes[0]
+        if key_node.__is_message() or key_node._is_repeated or key_node._repeated_count > 1:
+            # 主键是结构体或数组时不能按主键查找
+            key_node = None
+        index_nodes = [node for node in self._sub_nodes if node._is_index]
+        for node in index_nodes:
+            if node.__is_message() or node._is_repeated or node._repeated_count > 1:
+                raise Exception("{0}是结构体或数组，不能加index特性".format(node._name))
+        for node in self.__nested_index_nodes():
+            raise Exception("{0}不是第一层的字段，不能加index特性".format(node._name))
+        sheet_type = self._type
+        loader_module_name = os.path.splitext(loader_file_name)[0]
+        load_func_name = "load_" + sheet_type.lower()
+        usage = ["#     from {0} import {1}".format(loader_module_name, load_func_name),
+                 "#     {0} = {1}(\"{2}\")".format(sheet_type.lower(), load_func_name, DATA_GEN_PATH + OUTPUT_FILE_BASE + sheet_type.lower() + ".data")]
+        if key_node:
+            usage.append("#     item = {0}.Get(key)".format(sheet_type.lower()))
+        for node in index_nodes:
+            usage.append("#     items = {0}.FindBy{1}(value)".format(sheet_type.lower(), DescTree.__camel_name(node._name)))
+
+        output = "#! /usr/bin/env python3\n#coding=utf-8\n\n"
+        output += "##\n# @file:   " + loader_file_name + "\n"
+        output += "# @brief:  这个文件是通过工具自动生成的，不要手动修改\n#\n"
+        output += "# 用法：\n" + "\n".join(usage) + "\n##\n"
+        output += "from {0} import {1}, {1}_ARRAY\n\n".format(py_module_name, sheet_type)
+        output += "# 主键\nKEY_FIELD = {0}\n".format(repr(key_node._name) if key_node else "None")
+        output += "# 加了index特性的字段\nINDEX_FIELDS = {0}\n\n".format(repr(tuple([node._name for node in index_nodes])))
+        output += "class {0}_TABLE:\n".format(sheet_type)
+        output += "    \"\"\"{0}的全部数据。索引第一次用到时才建立，之后按主键和index字段查找都不用遍历\"\"\"\n\n".format(sheet_type)
+        output += "    def __init__(self, item_array):\n"
+        output += "        self.items = item_array.items\n"
+        output += "        # 主键 -> item\n        self._key_index = None\n"
+        output += "        # 字段名 -> {值 -> (item, ...)}\n        self._field_indexes = {}\n\n"
+        output += "    def __len__(self):\n        return len(self.items)\n\n"
+        output += "    def __iter__(self):\n        return iter(self.items)\n"
+        if key_node:
+            output += "\n    def __contains__(self, key):\n        return key in self.__key_index()\n\n"
+            output += "    def Get(self, key, default = None):\n"
+            output += "        \"\"\"按主键取一条数据，找不到时返回default\"\"\"\n"
+            output += "        return self.__key_index().get(key, default)\n"
+        for node in index_nodes:
+            output += "\n    def FindBy{0}(self, value):\n".format(DescTree.__camel_name(node._name))
+            output += "        \"\"\"{0}等于value的所有数据，按表中的顺序\"\"\"\n".format(node._name)
+            output += "        return self.__find({0}, value)\n".format(repr(node._name))
+        if key_node:
+            output += "\n    def __key_index(self):\n"
+            output += "        \"\"\"主键重复时取第一条，和按顺序查找的结果一致\"\"\"\n"
+            output += "        if self._key_index is None:\n"
+            output += "            key_index = {}\n"
+            output += "            for item in self.items:\n"
+            output += "                key_index.setdefault(item.{0}, item)\n".format(key_node._name)
+            output += "            self._key_index = key_index\n"
+            output += "        return self._key_index\n"
+        if index_nodes:
+            output += "\n    def __find(self, field_name, value):\n"
+            output += "        field_index = self._field_indexes.get(field_name)\n"
+            output += "        if field_index is None:\n"
+            output += "            field_index = {}\n"
+            output += "            for item in self.items:\n"
+            output += "                field_index.setdefault(getattr(item, field_name), []).append(item)\n"
+            output += "            field_index = dict([(field_value, tuple(items)) for field_value, items in field_index.items()])\n"
+            output += "            self._field_indexes[field_name] = field_index\n"
+            output += "        return field_index.get(value, ())\n"
+        output += "\ndef {0}(pathname):\n".format(load_func_name)
+        output += "    \"\"\"读取data文件\"\"\"\n"
+        output += "    data_file = open(pathname, 'rb')\n"
+        output += "    try:\n"
+        output += "        return {0}_TABLE({0}_ARRAY.FromString(data_file.read()))\n".format(sheet_type)
+        output += "    finally:\n"
+        output += "        data_file.close()\n"
+        write_file_atomic(PYTHON_GEN_PATH + loader_file_name, output.encode("utf-8"))
+
+    def __nested_index_nodes(self):
+        """结构体内部加了index特性的节点"""
+        nodes = []
+        for node in self._sub_nodes:
+            nodes += [sub_node for sub_node in node._sub_nodes if sub_node._is_index] + node.__nested_index_nodes()
+        return nodes
+
+    @staticmethod
+    def __camel_name(name):
+        """item_type -> ItemType"""
+        return "".join([part[:1].upper() + part[1:] for part in name.split("_")])
+
+    def GenFileDescriptorProto(self, pb_file_name):
+        """不调用protoc，直接生成和GenProto的proto等价的FileDescriptorProto"""
+        from google.protobuf import descriptor_pb2
+        file_proto = descriptor_pb2.FileDescriptorProto()
+        file_proto.name = pb_file_name
+        file_proto.package = PB_PACKAGE
+        file_proto.dependency.extend(sorted(DescTree.__used_modules))
+        # 内部类型名 -> 全名
+        local_defined_struct = {}
+        # 引用了message类型的域，所有内部类型生成完后再确定类型名
+        message_fields = []
+        self.__gen_message_proto(file_proto.message_type, PB_PACKAGE, local_defined_struct, message_fields)
+        for field_proto, node in message_fields:
+            enum_desc = None if node.__is_message() else common_modules.FindEnum(node._type)
+            if node._is_common_type:
+                field_proto.type_name = "." + node._pb_desc.full_name
+            elif node._type in local_defined_struct:
+                field_proto.type_name = "." + local_defined_struct[node._type]
+            elif enum_desc is not None:
+                field_proto.type = TYPE_ENUM
+                field_proto.type_name = "." + enum_desc.full_name
+            else:
+                raise Exception("{0}的类型{1}未定义".format(node._name, node._type))
+
+        array_proto = file_proto.message_type.add()
+        array_proto.name = self._type + "_ARRAY"
+        items_proto = array_proto.field.add()
+        items_proto.name = "items"
+        items_proto.number = 1
+        items_proto.label = LABEL_REPEATED
+        items_proto.type = TYPE_MESSAGE
+        items_proto.type_name = "." + local_defined_struct[self._type]
+        return file_proto
+
     def RecheckFieldDesc(self, pb_desc = None):
         if pb_desc:
             self._pb_desc = pb_desc
@@ -200,61 +683,26 @@ class DescTree:
             if node.__is_message() and not node._is_common_type:
                 node._pb_desc = self._pb_desc.nested_types_by_name[node._type]
                 node.RecheckFieldDesc()
+        # 域描述都确定了，编译解码计划
+        if self._parent is None:
+            self.CompileDecoder()
 
-    def ParseData(self, item, row_values, repeated_num = 0):
-        # 遍历子节点
-        for node in self._sub_nodes:
-            # 数组
-            if node._is_repeated:
-                for num in range(repeated_num * node._repeated_count, repeated_num * node._repeated_count + node._repeated_count):
-                    # struct结构的数组
-                    if node.__is_message():
-                            # 默认值
-                            if not node._nokey and node.__first_child_is_default_value(row_values, num):
-                                #print("读到默认值，忽略该结构，继续循环")
-                                continue
-                            struct_item = item.__getattribute__(node._name).add()
-                            node.ParseData(struct_item, row_values, num)
-                            if node._nokey and node.__is_all_default(struct_item):
-                                item.__getattribute__(node._name).__delitem__(-1)
-                                #print("该结构全部是默认值，忽略，继续循环")
-                                continue
-                    else:
-                        cell_value = node.__get_node_value(row_values, num)
-                        if cell_value == "":
-                            continue
-                        if node._field_desc.cpp_type in [1, 2, 3, 4, 7, 8]:
-                            # 单列分割
-                            if node._repeated_count == 1:
-                                item.__getattribute__(node._name).extend([int(float(x)) for x in str(cell_value).split(';')])
-                            else:
-                                item.__getattribute__(node._name).append(int(float(cell_value)))
-                        elif node._field_desc.cpp_type in [5, 6]:
-                            # 单列分割
-                            if node._repeated_count == 1:
-                                item.__getattribute__(node._name).extend([float(x) for x in cell_value.split(';')])
-                            else:
-                                item.__getattribute__(node._name).append(float(cell_value))
-                        else:
-                            item.__getattribute__(node._name).append(cell_value)
-            # 结构体
-            elif node.__is_message():
-                struct_item = item.__getattribute__(node._name)
-                node.ParseData(struct_item, row_values, repeated_num)
-            else:
-                cell_value = node.__get_node_value(row_values, repeated_num)
-                # 没有值，忽略
-                if cell_value == "":
-                    continue
-                # int类型
-                if node._field_desc.cpp_type in [1, 2, 3, 4, 7, 8]:
-                    item.__setattr__(node._name, int(cell_value))
-                # float类型
-                elif node._field_desc.cpp_type in [5, 6]:
-                    item.__setattr__(node._name, float(cell_value))
-                # 字符串类型
-                else:
-                    item.__setattr__(node._name, cell_value)
+    def CompileDecoder(self):
+        """把描述树编译成解码计划：每个字段对应的列、转换函数、数组的每个元素都预先算好，逐行解析时不用再遍历树"""
+        self._counters = {"skipped_defaults": 0}
+        self._decode_plan = self.__compile_plan(0)
+
+    def ParseData(self, item, row_values):
+        """按解码计划解析一行数据"""
+        if self._decode_plan is None:
+            self.CompileDecoder()
+        for step in self._decode_plan:
+            step(item, row_values)
+
+    @staticmethod
+    def ClearUsedModules():
+        """批量导出时，每个页签开始前清掉上一个页签用到的公共模块"""
+        DescTree.__used_modules.clear()
 
     @staticmethod
     def gen_comm_module():
@@ -266,22 +714,25 @@ class DescTree:
         # 空，直接返回
         if type_name == "":
             return False, None
-        # 遍历公共模块
-        for module in comm_loaded_modules:
-            if type_name in module.DESCRIPTOR.message_types_by_name:
-                DescTree.__used_modules.add(module.DESCRIPTOR.name)
-                return True, module.DESCRIPTOR.message_types_by_name[type_name]
-        return False, None
+        # 查公共模块的类型索引
+        message_desc = common_modules.FindType(type_name)
+        if message_desc is None:
+            return False, None
+        DescTree.__used_modules.add(message_desc.file.name)
+        return True, message_desc
 
     def __is_message(self):
         return len(self._sub_nodes) > 0
 
-    def __split_type(self, type_name):
+    @staticmethod
+    def __split_type(type_name):
+        """分割出类型名、默认值和特性。同样的类型字符串只分割一次"""
+        if type_name in DescTree.__split_type_cache:
+            return DescTree.__split_type_cache[type_name]
         real_type_name = ""
         default_val = None
         features = ""
-        import re
-        match_result = re.split(r'[\[\]\=]', type_name)
+        match_result = TYPE_SPLIT_RE.split(type_name)
         if len(match_result) == 2:
             real_type_name = match_result[0]
             default_val = match_result[1]
@@ -294,6 +745,7 @@ class DescTree:
             default_val = match_result[3]
         else:
             real_type_name = match_result[0]
+        DescTree.__split_type_cache[type_name] = (real_type_name, default_val, features)
         return real_type_name, default_val, features
 
     def __init_private_type(self, type_name):
@@ -305,7 +757,12 @@ class DescTree:
         self._is_hour = False
         self._nokey = False
         self._not_repeated = False
-        self._type, self._default, features = self.__split_type(type_name)
+        # 生成加载模块时按这个字段建索引
+        self._is_index = False
+        # 校验用：数值范围(最小值, 最大值)，引用的页签
+        self._value_range = None
+        self._ref_sheet = None
+        self._type, self._default, features = DescTree.__split_type(type_name)
         # 设置特性
         for feature in [x.strip() for x in features.split(',')]:
             if feature == "repeated":
@@ -318,21 +775,39 @@ class DescTree:
                 self._nokey = True
             elif feature == "norepeated":
                 self._not_repeated = True
+            elif feature == "index":
+                self._is_index = True
+            elif feature.startswith("range:"):
+                self._value_range = DescTree.__parse_range(feature)
+            elif feature.startswith("ref:"):
+                self._ref_sheet = feature[len("ref:"):].strip()
 
-    def __get_node_by_name(self, node_name):
-        """根据名称获取子节点"""
-        node_list = [node for node in self._sub_nodes if node._name == node_name]
-        return node_list[0] if len(node_list)==1 else  None
+    @staticmethod
+    def __parse_range(feature):
+        """range:最小值~最大值，省略一边表示不限"""
+        bounds = feature[len("range:"):].split('~')
+        try:
+            if len(bounds) != 2:
+                raise ValueError(feature)
+            return [float(bound) if bound.strip() else None for bound in bounds]
+        except ValueError:
+            raise Exception("{0}格式错误，应为range:最小值~最大值".format(feature)) from None
 
     def __create_subnode(self, curr_node_name, curr_type_name, str_comment, is_leaf):
         node = DescTree(curr_node_name, curr_type_name, str_comment)
         node._parent = self
         self._sub_nodes.append(node)
+        self._sub_node_index[curr_node_name] = node
         # 继承自父节点，是否是公共类型
         node._is_common_type = self._is_common_type
         # 确定是否是公共类型
         if not node._is_common_type and node._type != "":
             node._is_common_type, node._pb_desc = DescTree.__is_type_defined(node._type)
+            # 公共模块中的enum，要import定义它的模块
+            if not node._is_common_type and is_leaf and node._type not in SCALAR_FIELD_TYPES:
+                enum_desc = common_modules.FindEnum(node._type)
+                if enum_desc is not None:
+                    DescTree.__used_modules.add(enum_desc.file.name)
         elif self._is_common_type and not is_leaf:
             type_name = self._pb_desc.fields_by_name[node._name].message_type.name
             _, node._pb_desc = DescTree.__is_type_defined(type_name)
@@ -348,7 +823,7 @@ class DescTree:
                 node._field_desc = self._pb_desc.fields_by_name[node._name]
                 node._order_number = node._field_desc.number
                 # 公共类型，且是repeated的，则强制指定
-                if self._is_common_type and node._field_desc.label == 3:
+                if self._is_common_type and is_repeated_field(node._field_desc):
                     node._is_repeated = True
             elif self._is_common_type:
                 raise Exception("subnode %s is not one field of %s." % (node._name, self._type))
@@ -380,75 +855,272 @@ class DescTree:
             local_defined_struct[self._type] = 1
         return output
 
-    def __first_child_is_default_value(self, row_values, num):
-        # 一直遍历首个子节点
-        if self._sub_nodes:
-            return self._sub_nodes[0].__first_child_is_default_value(row_values, num)
+    def __gen_message_proto(self, container, scope, local_defined_struct, message_fields):
+        """生成message的DescriptorProto，和__gen_node_desc的规则一致"""
+        # 已经定义过
+        if self._type in local_defined_struct:
+            return
+        if not self.__is_message() or self._is_common_type:
+            return
+        message_proto = container.add()
+        message_proto.name = self._type
+        full_name = scope + "." + self._type
+        for node in self._sub_nodes:
+            # 是消息类型，生成内部类型
+            if node.__is_message():
+                node.__gen_message_proto(message_proto.nested_type, full_name, local_defined_struct, message_fields)
+        for node in self._sub_nodes:
+            field_proto = message_proto.field.add()
+            field_proto.name = node._name
+            field_proto.number = node._order_number
+            field_proto.label = LABEL_REPEATED if node._is_repeated or node._repeated_count > 1 else LABEL_OPTIONAL
+            if node._type in SCALAR_FIELD_TYPES:
+                field_proto.type = SCALAR_FIELD_TYPES[node._type]
+            else:
+                field_proto.type = TYPE_MESSAGE
+                message_fields.append((field_proto, node))
+            if node._default:
+                # proto里字符串默认值带引号
+                field_proto.default_value = str(node._default).strip('"')
+        local_defined_struct[self._type] = full_name
+
+    def __compile_plan(self, repeated_num):
+        """编译第repeated_num个结构的解码步骤，每个子节点对应一个步骤"""
+        plan = []
+        for node in self._sub_nodes:
+            if node._is_repeated:
+                # 数组的每个元素对应的序号
+                slots = range(repeated_num * node._repeated_count, repeated_num * node._repeated_count + node._repeated_count)
+                if node.__is_message():
+                    plan.append(node.__compile_repeated_struct(slots))
+                else:
+                    plan.append(node.__compile_repeated_leaf(slots))
+            elif node.__is_message():
+                plan.append(node.__compile_struct(repeated_num))
+            else:
+                plan.append(node.__compile_leaf(repeated_num))
+        return plan
+
+    def __compile_struct(self, num):
+        """结构体"""
+        name = self._name
+        sub_plan = self.__compile_plan(num)
+        def decode_struct(item, row_values):
+            struct_item = getattr(item, name)
+            for step in sub_plan:
+                step(struct_item, row_values)
+        return decode_struct
+
+    def __compile_leaf(self, num):
+        """普通字段"""
+        name = self._name
+        col = self.__get_col(num)
+        convert = self.__make_converter(col)
+        def decode_leaf(item, row_values):
+            cell_value = convert(row_values[col])
+            # 没有值，忽略
+            if cell_value is not None:
+                setattr(item, name, cell_value)
+        return decode_leaf
+
+    def __compile_repeated_leaf(self, slots):
+        """数组字段。只有一列时，单元格内用';'分割"""
+        name = self._name
+        cols = [self.__get_col(num) for num in slots]
+        cpp_type = self._field_desc.cpp_type
+        if self._repeated_count == 1:
+            col = cols[0]
+            if cpp_type in INT_CPP_TYPES:
+                split_convert = lambda x: int(float(x))
+            elif cpp_type in FLOAT_CPP_TYPES:
+                split_convert = float
+            else:
+                split_convert = None
+            def decode_split_leaf(item, row_values):
+                cell_value = row_values[col]
+                # 已经列式转换好了
+                if type(cell_value) is PackedValues:
+                    getattr(item, name).extend(cell_value)
+                    return
+                if is_blank_cell(cell_value):
+                    return
+                if split_convert:
+                    try:
+                        values = [split_convert(x) for x in str(cell_value).split(';')]
+                    except (ValueError, OverflowError):
+                        raise CellValueError(col, cell_value) from None
+                    getattr(item, name).extend(values)
+                else:
+                    getattr(item, name).append(cell_value)
+            return decode_split_leaf
+
+        converts = [(col, self.__make_converter(col)) for col in cols]
+        def decode_repeated_leaf(item, row_values):
+            for col, convert in converts:
+                cell_value = convert(row_values[col])
+                if cell_value is not None:
+                    getattr(item, name).append(cell_value)
+        return decode_repeated_leaf
+
+    def __compile_repeated_struct(self, slots):
+        """struct结构的数组。nokey的结构全部是默认值时忽略，否则首个字段是默认值时忽略"""
+        name = self._name
+        nokey = self._nokey
+        slot_plans = [(None if nokey else self.__compile_key_check(num), self.__compile_plan(num)) for num in slots]
+        root = self
+        while root._parent:
+            root = root._parent
+        counters = root._counters
+        def decode_repeated_struct(item, row_values):
+            struct_items = getattr(item, name)
+            for is_default_key, sub_plan in slot_plans:
+                # 默认值
+                if is_default_key and is_default_key(row_values):
+                    counters["skipped_defaults"] += 1
+                    continue
+                struct_item = struct_items.add()
+                for step in sub_plan:
+                    step(struct_item, row_values)
+                if nokey and DescTree.__is_all_default(struct_item):
+                    del struct_items[-1]
+                    counters["skipped_defaults"] += 1
+        return decode_repeated_struct
+
+    def __compile_key_check(self, num):
+        """首个字段(一直找到叶节点)是否为默认值的判断函数"""
+        key_node = self
+        while key_node._sub_nodes:
+            key_node = key_node._sub_nodes[0]
         # 叶节点是repeated的，不做默认值判断
-        if self._is_repeated:
-            return False
-        # 获取到单元格内容
-        cell_value = self.__get_node_value(row_values, num)
-        if str(cell_value) == "":
-            return True
-        return self._field_desc.default_value == cell_value
-
-    def __is_all_default(self, item):
+        if key_node._is_repeated:
+            return None
+        col = key_node.__get_col(num)
+        convert = key_node.__make_converter(col)
+        default_value = key_node._field_desc.default_value
+        def is_default_key(row_values):
+            cell_value = convert(row_values[col])
+            return cell_value is None or cell_value == default_value
+        return is_default_key
+
+    def __get_col(self, num):
+        """第num个元素对应的列"""
+        if num >= len(self._col_array):
+            raise Exception("{0}的第{1}个元素找不到对应的列，请检查表头".format(self._name, num + 1))
+        return self._col_array[num]
+
+    @staticmethod
+    def __is_all_default(item):
         """判断是否全部为默认值"""
-        for (desc, val) in item._fields.items():
+        for (desc, val) in item.ListFields():
             # 数组,长度不为0则不是默认值
-            if desc.label == 3:
-                if val and len(val) != 0:
+            if is_repeated_field(desc):
+                if len(val) != 0:
                     return False
             elif desc.message_type:
-                if not self.__is_all_default(val):
+                if not DescTree.__is_all_default(val):
                     return False
             elif desc.default_value != val:
                 return False
         return True
 
-    def __get_node_value(self, row_values, num):
-        """获取单元格内容"""
-        cell_value = row_values[self._col_array[num]]
-        #print("列单元格(%s)值为%s" % (decimal2az(self._col_array[num]), str(cell_value)))
-        if str(cell_value).strip() == "":
-            return ""
-        elif self._is_repeated and self._repeated_count == 1:
-            return cell_value
-        try:
-            # 整数
-            if self._field_desc.cpp_type in [1, 2, 3, 4, 7, 8]:
+    def __make_converter(self, col):
+        """生成col列的单元格转换函数，空单元格返回None，内容错误抛出CellValueError"""
+        cpp_type = self._field_desc.cpp_type
+        # 整数
+        if cpp_type in INT_CPP_TYPES:
+            if not self._is_date and not self._is_hour:
+                def convert_int(cell_value):
+                    if is_blank_cell(cell_value):
+                        return None
+                    try:
+                        return int(float(cell_value))
+                    except (ValueError, TypeError, OverflowError):
+                        raise CellValueError(col, cell_value) from None
+                return convert_int
+            # 支持时间类型
+            parse_time = parse_date_time if self._is_date else parse_hour_time
+            def convert_time(cell_value):
+                # 已经列式转换好了
+                if type(cell_value) is ConvertedTime:
+                    return int(cell_value)
+                if is_blank_cell(cell_value):
+                    return None
+                # 填0表示没有时间
                 try:
-                    tmp = int(float(cell_value))
-                    if tmp == 0:
+                    if int(float(cell_value)) == 0:
                         return 0
-                except:
-                    pass 
-                # 支持时间类型
-                if self._is_date:
-                    import time
-                    time_struct = time.strptime(cell_value, "%Y-%m-%d %H:%M:%S")
-                    return int(time.mktime(time_struct))
-                elif self._is_hour:
-                    import time
-                    time_base = "2000-01-01 "
-                    time_struct = time.strptime(time_base + cell_value, "%Y-%m-%d %H:%M:%S")
-                    time_struct_base = time.strptime(time_base + "00:00:00", "%Y-%m-%d %H:%M:%S")
-                    return int(time.mktime(time_struct)) - int(time.mktime(time_struct_base))
-                return int(float(cell_value))
-            # 浮点数
-            elif self._field_desc.cpp_type in [5, 6]:
-                return float(cell_value)
-        except:
-            raise BaseException("列单元格({})内容错误({})，请检查".format(decimal2az(self._col_array[num]), cell_value))
-        # string或bytes
-        if str(cell_value).endswith('.0'):
-            try:
-                tmp = int(float(cell_value))
-                return unicode(tmp)
-            except:
-                pass
-        return unicode(cell_value)
+                except (ValueError, TypeError, OverflowError):
+                    pass
+                try:
+                    return parse_time(cell_value)
+                except (ValueError, TypeError, OverflowError):
+                    raise CellValueError(col, cell_value) from None
+            return convert_time
+        # 浮点数
+        elif cpp_type in FLOAT_CPP_TYPES:
+            def convert_float(cell_value):
+                if is_blank_cell(cell_value):
+                    return None
+                try:
+                    return float(cell_value)
+                except (ValueError, TypeError):
+                    raise CellValueError(col, cell_value) from None
+            return convert_float
+        # string或bytes。xlrd读出的文本已经是str，直接用，不再转换。整数显示为不带.0的形式
+        def convert_string(cell_value):
+            if type(cell_value) is not str:
+                cell_value = str(cell_value)
+            elif cell_value.strip() == "":
+                return None
+            if cell_value.endswith('.0'):
+                try:
+                    return str(int(float(cell_value)))
+                except (ValueError, OverflowError):
+                    pass
+            return cell_value
+        if self._field_desc.type == SCALAR_FIELD_TYPES["bytes"]:
+            def convert_bytes(cell_value):
+                text = convert_string(cell_value)
+                return None if text is None else text.encode("utf-8")
+            return convert_bytes
+        return convert_string
+
+class PbModule:
+    """进程内生成的message类，用法和protoc生成的_pb2模块一样"""
+
+    def __init__(self, file_proto):
+        from google.protobuf import descriptor_pool
+        from google.protobuf import message_factory
+        pool = descriptor_pool.DescriptorPool()
+        # 依赖的公共模块先加到pool中
+        added_files = set()
+        for dependency in file_proto.dependency:
+            file_desc = common_modules.FindFile(dependency)
+            if file_desc is None:
+                raise Exception("找不到{0}依赖的{1}，请检查common_def.py中的COMMON_MODULES".format(file_proto.name, dependency))
+            PbModule.__add_file(pool, file_desc, added_files)
+        pool.Add(file_proto)
+        self.DESCRIPTOR = pool.FindFileByName(file_proto.name)
+        factory = message_factory.MessageFactory(pool)
+        for name, message_desc in self.DESCRIPTOR.message_types_by_name.items():
+            # 新版本protobuf用GetMessageClass代替了GetPrototype
+            if hasattr(message_factory, "GetMessageClass"):
+                setattr(self, name, message_factory.GetMessageClass(message_desc))
+            else:
+                setattr(self, name, factory.GetPrototype(message_desc))
+
+    @staticmethod
+    def __add_file(pool, file_desc, added_files):
+        """把文件及其依赖加到pool中"""
+        if file_desc.name in added_files:
+            return
+        for dependency in file_desc.dependencies:
+            PbModule.__add_file(pool, dependency, added_files)
+        from google.protobuf import descriptor_pb2
+        file_proto = descriptor_pb2.FileDescriptorProto()
+        file_desc.CopyToProto(file_proto)
+        pool.Add(file_proto)
+        added_files.add(file_desc.name)
 
 # protoc 
 PROTOC_PATH = PROTOC + " -I" + PB_PROTO + " -I" + CUSTOM_PROTO
@@ -456,8 +1128,6 @@ PROTOC_PATH = PROTOC + " -I" + PB_PROTO + " -I" + CUSTOM_PROTO
 OUTPUT_FILE_BASE="dataconfig_"
 # proto路径
 create_path_if_noexist(PROTO_GEN_PATH)
-# python导出路径
-create_path_if_noexist(PYTHON_GEN_PATH)
 # 数据文件
 create_path_if_noexist(DATA_GEN_PATH)
 # 文本文件
@@ -468,110 +1138,1529 @@ FIELD_TYPE_ROW = 0
 FIELD_NAME_ROW = 1
 FIELD_COMMENT_ROW = 2
 
+# 增量导出的缓存文件，放在数据目录旁边
+EXPORT_CACHE_FILE = os.path.normpath(DATA_GEN_PATH) + ".cache.json"
+
+# 增量导出时页签需要做的工作
+SKIP_EXPORT = 0
+DATA_EXPORT = 1
+FULL_EXPORT = 2
+
+# <SHEET>_ARRAY中items字段(field 1, wire type 2)的tag
+ITEMS_FIELD_TAG = encode_varint((1 << 3) | 2)
+
+def shortest_float32(value):
+    """float域实际是32位精度，转成能还原出同样32位值的最短小数，和text格式的输出一致"""
+    import struct
+    float32 = struct.unpack('<f', struct.pack('<f', value))[0]
+    for precision in range(6, 10):
+        short_value = float("%.*g" % (precision, value))
+        if struct.unpack('<f', struct.pack('<f', short_value))[0] == float32:
+            return short_value
+    return float32
+
+def message_to_dict(message):
+    """message转成dict，只包括设置过的域，按字段号排序"""
+    from collections import OrderedDict
+    result = OrderedDict()
+    for field_desc, value in message.ListFields():
+        if field_desc.cpp_type == 10:
+            convert = message_to_dict
+        elif field_desc.cpp_type == 6:
+            convert = shortest_float32
+        elif field_desc.type == SCALAR_FIELD_TYPES["bytes"]:
+            convert = lambda x: x.decode("utf-8", "replace")
+        else:
+            convert = lambda x: x
+        if is_repeated_field(field_desc):
+            result[field_desc.name] = [convert(element) for element in value]
+        else:
+            result[field_desc.name] = convert(value)
+    return result
+
+class TextDataWriter:
+    """逐条写出可读文本，不在内存中拼出整个文件。每条item的格式固定，改一行数据只影响文本中对应的几行。
+    text_format为"txt"时和MessageToString(item_array)的输出一致，为"jsonl"时每条item一行json。
+    shard_rows大于0时每shard_rows条写一个文件"""
+
+    # 文本格式 -> 扩展名
+    EXTENSIONS = {"txt": ".txt", "jsonl": ".jsonl"}
+
+    def __init__(self, file_base, text_format = "txt", shard_rows = 0):
+        if text_format not in TextDataWriter.EXTENSIONS:
+            raise Exception("未知的文本格式" + text_format)
+        self._file_base = file_base
+        self._text_format = text_format
+        self._shard_rows = shard_rows
+        self._file = None
+        self._rows = 0
+        # 已打开的所有文件，Close时统一改名
+        self._pathnames = []
+        # 已写的字节数
+        self.bytes_written = 0
+
+    @staticmethod
+    def FileName(file_base, text_format, shard = None):
+        """不分文件时是file_base.txt，分文件时是file_base.00000.txt"""
+        if shard is None:
+            return file_base + TextDataWriter.EXTENSIONS[text_format]
+        return file_base + ".%05d" % shard + TextDataWriter.EXTENSIONS[text_format]
+
+    @staticmethod
+    def Render(item, text_format = "txt"):
+        """一条item的文本(utf-8)。行并行解析时在工作进程中生成，再按顺序写"""
+        if text_format == "jsonl":
+            line = json.dumps(message_to_dict(item), ensure_ascii = False, separators = (',', ':'))
+            return (line + "\n").encode("utf-8")
+        from google.protobuf import text_format as pb_text_format
+        return ("items {\n" + pb_text_format.MessageToString(item, indent = 2, as_utf8 = True) + "}\n").encode("utf-8")
+
+    def Write(self, item):
+        """写一条item"""
+        self.WriteText(TextDataWriter.Render(item, self._text_format))
+
+    def WriteText(self, text):
+        """写一条已经生成好的item文本"""
+        if self._file is None or (self._shard_rows and self._rows % self._shard_rows == 0):
+            self.__open_next()
+        self._rows += 1
+        self._file.write(text)
+
+    def Close(self):
+        """写完后改名为正式文件，删除之前导出的、这次没有生成的文本文件"""
+        if self._file is None:
+            # 没有数据也生成一个空文件
+            self.__open_next()
+        self._file.close()
+        for pathname in self._pathnames:
+            self.bytes_written += os.path.getsize(pathname + ".tmp")
+            rename_file(pathname + ".tmp", pathname)
+        for pathname in self.__old_files():
+            if pathname not in self._pathnames:
+                os.remove(pathname)
+
+    def Abort(self):
+        """出错时删除临时文件"""
+        if self._file:
+            self._file.close()
+        for pathname in self._pathnames:
+            os.remove(pathname + ".tmp")
+
+    def __open_next(self):
+        if self._file:
+            self._file.close()
+        shard = len(self._pathnames) if self._shard_rows else None
+        pathname = TextDataWriter.FileName(self._file_base, self._text_format, shard)
+        self._pathnames.append(pathname)
+        self._file = open(pathname + ".tmp", 'wb')
+
+    def __old_files(self):
+        """已有的各种格式、分文件方式的文本文件"""
+        for text_format in TextDataWriter.EXTENSIONS:
+            pathname = TextDataWriter.FileName(self._file_base, text_format)
+            if os.path.isfile(pathname):
+                yield pathname
+            shard = 0
+            while os.path.isfile(TextDataWriter.FileName(self._file_base, text_format, shard)):
+                yield TextDataWriter.FileName(self._file_base, text_format, shard)
+                shard += 1
+
+# data分片清单的后缀
+SHARD_MANIFEST_SUFFIX = ".shards.json"
+
+def write_data_shards(file_base, sheet_name, data, keys, shard_rows, shard_bytes):
+    """把data切成多个独立的_ARRAY文件(file_base.00000.data)，每个分片最多shard_rows条、shard_bytes字节(至少一条)，
+    清单中记录每个分片的行数、字节数、主键范围和md5。内容没变的分片不重写，返回写出的字节数"""
+    import hashlib
+    manifest_pathname = file_base + SHARD_MANIFEST_SUFFIX
+    old_md5s = dict([(shard["file"], shard["md5"]) for shard in load_shard_manifest(manifest_pathname).get("shards", [])])
+    shards = []
+    bytes_written = [0]
+    def flush(begin, end, first_item, end_item):
+        shard_file = os.path.basename(file_base) + ".%05d.data" % len(shards)
+        content = data[begin:end]
+        shard = {"file": shard_file, "rows": end_item - first_item, "bytes": end - begin, "md5": hashlib.md5(content).hexdigest()}
+        if keys is not None:
+            shard_keys = keys[first_item:end_item]
+            shard["min_key"] = min(shard_keys)
+            shard["max_key"] = max(shard_keys)
+        shards.append(shard)
+        shard_pathname = os.path.join(os.path.dirname(file_base), shard_file)
+        if old_md5s.get(shard_file) != shard["md5"] or not os.path.isfile(shard_pathname):
+            bytes_written[0] += write_file_atomic(shard_pathname, content)
+
+    # 每条记录是items字段的tag+长度+内容，记录首尾相连
+    begin = end = 0
+    first_item = 0
+    for num, (offset, length) in enumerate(xls_pb_index.iter_item_spans(data)):
+        record_end = offset + length
+        if num > first_item and ((shard_rows and num - first_item >= shard_rows) or
+                                 (shard_bytes and record_end - begin > shard_bytes)):
+            flush(begin, end, first_item, num)
+            begin = end
+            first_item = num
+        end = record_end
+    if end > begin:
+        flush(begin, end, first_item, num + 1)
+
+    remove_data_shards(file_base, len(shards))
+    manifest = {"sheet": sheet_name, "rows": sum([shard["rows"] for shard in shards]), "shards": shards,
+                "shard_rows": shard_rows, "shard_bytes": shard_bytes}
+    bytes_written[0] += write_file_atomic(manifest_pathname, json.dumps(manifest, indent = 4, sort_keys = True, separators = (',', ': ')).encode("utf-8"))
+    return bytes_written[0]
+
+def load_shard_manifest(manifest_pathname):
+    """读取分片清单，没有时返回空的dict"""
+    if not os.path.isfile(manifest_pathname):
+        return {}
+    try:
+        return json.load(open(manifest_pathname, 'rb'))
+    except ValueError:
+        return {}
+
+def data_shards_changed(file_base, shard_rows, shard_bytes):
+    """已有的分片和这次的分片设置不一致。不分片时有旧的分片也算不一致"""
+    manifest = load_shard_manifest(file_base + SHARD_MANIFEST_SUFFIX)
+    if not manifest and not shard_rows and not shard_bytes:
+        return False
+    return [manifest.get("shard_rows"), manifest.get("shard_bytes")] != [shard_rows, shard_bytes]
+
+def remove_data_shards(file_base, begin_shard = 0):
+    """删除第begin_shard个以后的分片。begin_shard为0时连清单一起删除"""
+    shard = begin_shard
+    while os.path.isfile(file_base + ".%05d.data" % shard):
+        os.remove(file_base + ".%05d.data" % shard)
+        shard += 1
+    if begin_shard == 0 and os.path.isfile(file_base + SHARD_MANIFEST_SUFFIX):
+        os.remove(file_base + SHARD_MANIFEST_SUFFIX)
+
+class StreamDataWriter:
+    """逐条写出items。每条记录是items字段的tag+长度+内容，拼起来正好是整个_ARRAY序列化后的结果"""
+
+    def __init__(self, data_pathname, text_writer):
+        self._data_pathname = data_pathname
+        self._text_writer = text_writer
+        self._data_file = open(data_pathname + ".tmp", 'wb')
+        # 已写的字节数
+        self.bytes_written = 0
+
+    def Write(self, item):
+        """写一条item"""
+        data = item.SerializeToString()
+        data_len = encode_varint(len(data))
+        self._data_file.write(ITEMS_FIELD_TAG)
+        self._data_file.write(data_len)
+        self._data_file.write(data)
+        self.bytes_written += len(ITEMS_FIELD_TAG) + len(data_len) + len(data)
+        self._text_writer.Write(item)
+
+    def Close(self):
+        """写完后改名为正式文件"""
+        self._data_file.close()
+        self._text_writer.Close()
+        self.bytes_written += self._text_writer.bytes_written
+        rename_file(self._data_pathname + ".tmp", self._data_pathname)
+
+    def Abort(self):
+        """出错时删除临时文件"""
+        self._data_file.close()
+        self._text_writer.Abort()
+        os.remove(self._data_pathname + ".tmp")
+
+class XlrdWorkbook:
+    """用xlrd读取excel。按需加载页签，同时只保留一个页签的内容"""
+
+    def __init__(self, xls_file):
+        self._workbook = xlrd.open_workbook(xls_file, on_demand = True)
+        self._loaded_sheet_name = None
+
+    def SheetNames(self):
+        return self._workbook.sheet_names()
+
+    def GetSheet(self, sheet_name):
+        """加载页签，并释放之前加载的页签"""
+        if self._loaded_sheet_name not in (None, sheet_name):
+            self._workbook.unload_sheet(self._loaded_sheet_name)
+        self._loaded_sheet_name = sheet_name
+        return XlrdSheetReader(self._workbook.sheet_by_name(sheet_name))
+
+    def Release(self):
+        self._workbook.release_resources()
+
+class XlrdSheetReader:
+    """xlrd页签"""
+
+    def __init__(self, sheet):
+        self._sheet = sheet
+        self.name = sheet.name
+
+    def HeaderRows(self):
+        """表头的类型、名称、注释行，行数不够时只返回已有的行"""
+        return [self._sheet.row_values(row) for row in range(min(FIELD_COMMENT_ROW + 1, self._sheet.nrows))]
+
+    def IterRows(self, begin_row):
+        """从begin_row开始逐行返回(行号, 行内容)"""
+        for row in range(begin_row, self._sheet.nrows):
+            yield row, self._sheet.row_values(row)
+
+class OpenpyxlWorkbook:
+    """用openpyxl的只读模式流式读取xlsx，内存中只保留当前行"""
+
+    def __init__(self, xls_file):
+        import openpyxl
+        self._workbook = openpyxl.load_workbook(xls_file, read_only = True, data_only = True)
+
+    def SheetNames(self):
+        return self._workbook.sheetnames
+
+    def GetSheet(self, sheet_name):
+        return OpenpyxlSheetReader(self._workbook[sheet_name])
+
+    def Release(self):
+        self._workbook.close()
+
+class OpenpyxlSheetReader:
+    """openpyxl页签。单元格的值转换成和xlrd一致：数字都是float，空单元格是空串，日期是excel的日期数值"""
+
+    def __init__(self, sheet):
+        self._sheet = sheet
+        self.name = sheet.title
+        self._ncols = 0
+
+    def HeaderRows(self):
+        header_rows = [self.__row_values(row) for row in self._sheet.iter_rows(min_row = 1, max_row = FIELD_COMMENT_ROW + 1, values_only = True)]
+        self._ncols = max([len(row_values) for row_values in header_rows] + [0])
+        return header_rows
+
+    def IterRows(self, begin_row):
+        if not self._ncols:
+            self.HeaderRows()
+        for row, row_values in enumerate(self._sheet.iter_rows(min_row = begin_row + 1, values_only = True), begin_row):
+            row_values = self.__row_values(row_values)
+            # 只读模式下每行的列数可能不同，补齐到表头的列数
+            if len(row_values) < self._ncols:
+                row_values += [u""] * (self._ncols - len(row_values))
+            yield row, row_values
+
+    @staticmethod
+    def __row_values(row_values):
+        import datetime
+        from openpyxl.utils.datetime import to_excel
+        result = []
+        for cell_value in row_values:
+            if cell_value is None:
+                cell_value = u""
+            elif isinstance(cell_value, bool):
+                cell_value = int(cell_value)
+            elif isinstance(cell_value, int):
+                cell_value = float(cell_value)
+            elif isinstance(cell_value, (datetime.datetime, datetime.date, datetime.time)):
+                cell_value = float(to_excel(cell_value))
+            result.append(cell_value)
+        return result
+
+def open_workbook(xls_file):
+    """根据文件类型选择读取方式。xlsx优先用openpyxl流式读取，没有安装openpyxl时用xlrd"""
+    if os.path.splitext(xls_file)[1].lower() in (".xlsx", ".xlsm"):
+        try:
+            import openpyxl
+            return OpenpyxlWorkbook(xls_file)
+        except ImportError:
+            pass
+    return XlrdWorkbook(xls_file)
+
+class ExportCache:
+    """增量导出缓存。记录每个页签上次导出成功时的表头、数据和环境hash"""
+
+    # 工具自身和公共模块的hash，进程内只算一次
+    __env_hash = None
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._entries = {}
+        if os.path.isfile(cache_file):
+            try:
+                self._entries = json.load(open(cache_file, 'rb'))
+            except ValueError:
+                # 缓存坏了就当没有缓存
+                self._entries = {}
+
+    def Get(self, sheet_task):
+        return self._entries.get(ExportCache.__key(sheet_task))
+
+    def Set(self, sheet_task, hashes):
+        self._entries[ExportCache.__key(sheet_task)] = hashes
+
+    def Remove(self, sheet_task):
+        self._entries.pop(ExportCache.__key(sheet_task), None)
+
+    def Tasks(self):
+        """缓存中的所有(excel, 页签)"""
+        return [tuple(key.rsplit("|", 1)) for key in self._entries]
+
+    def Save(self):
+        write_file_atomic(self._cache_file, json.dumps(self._entries, indent = 4, sort_keys = True, separators = (',', ': ')).encode("utf-8"))
+
+    @staticmethod
+    def SheetHashes(sheet):
+        """计算页签的hash。表头只包括类型、名称和注释行"""
+        import hashlib
+        header_md5 = hashlib.md5()
+        for row_values in sheet.HeaderRows():
+            header_md5.update(repr(row_values).encode("utf-8"))
+        data_md5 = hashlib.md5()
+        for _, row_values in sheet.IterRows(FIELD_COMMENT_ROW + 1):
+            data_md5.update(repr(row_values).encode("utf-8"))
+        return {"header": header_md5.hexdigest(), "data": data_md5.hexdigest(), "env": ExportCache.EnvHash()}
+
+    @staticmethod
+    def EnvHash():
+        """工具版本(源码)和所有公共模块的描述有变化，都要重新导出"""
+        if ExportCache.__env_hash is None:
+            import hashlib
+            env_md5 = hashlib.md5()
+            for module_file in [__file__, xls_pb_file.__file__, xls_pb_index.__file__, xls_pb_dedup.__file__, xls_pb_delta.__file__]:
+                env_md5.update(open(os.path.splitext(module_file)[0] + ".py", 'rb').read())
+            # 只读公共模块的源文件，不用import
+            for module_file in common_modules.ModuleFiles():
+                env_md5.update(open(module_file, 'rb').read())
+            ExportCache.__env_hash = env_md5.hexdigest()
+        return ExportCache.__env_hash
+
+    @staticmethod
+    def CheckMode(sheet_name, hashes, cached, options):
+        """对比缓存，返回该页签需要做的工作"""
+        if not cached or cached.get("env") != hashes["env"] or cached.get("header") != hashes["header"]:
+            return FULL_EXPORT
+        # 加载模块在生成proto时生成，打开或关掉都要重新生成proto
+        cached_outputs = cached.get("outputs") or {}
+        if cached_outputs.get("loader", False) != hashes["outputs"]["loader"]:
+            return FULL_EXPORT
+        # 产物被删掉了，也要重新导出
+        if not all([os.path.isfile(pathname) for pathname in sheet_output_files(sheet_name, options)]):
+            return FULL_EXPORT
+        if cached.get("data") != hashes["data"]:
+            return DATA_EXPORT
+        # 打开或关掉了索引、去重、增量文件，导出数据时生成或删除
+        if cached_outputs != hashes["outputs"]:
+            return DATA_EXPORT
+        # 文本的格式或者分文件的行数变了，文本要重新生成
+        if cached.get("text") != hashes.get("text"):
+            return DATA_EXPORT
+        # data分片的设置变了，分片要重新切
+        if data_shards_changed(DATA_GEN_PATH + OUTPUT_FILE_BASE + sheet_name.lower(), options.data_shard_rows, options.data_shard_bytes):
+            return DATA_EXPORT
+        # 上次导出时没有校验，缓存中没有校验规则，要重新导出数据才能校验
+        if options.validate and "rules" not in cached:
+            return DATA_EXPORT
+        return SKIP_EXPORT
+
+    @staticmethod
+    def __key(sheet_task):
+        xls_file, sheet_name = sheet_task
+        return xls_file + "|" + sheet_name
+
+def cpu_time():
+    """进程用户态和内核态的cpu时间"""
+    times = os.times()
+    return times[0] + times[1]
+
+class ExportProfile:
+    """一个页签导出过程的分阶段耗时(墙钟时间和cpu时间，单位秒)和计数"""
+
+    def __init__(self, name):
+        self.name = name
+        # 阶段名 -> [墙钟时间, cpu时间]
+        self.phases = {}
+        # 计数名 -> 数量
+        self.counters = {}
+
+    def Phase(self, phase_name):
+        """用with统计一个阶段的耗时，同名阶段累加"""
+        return _ProfilePhase(self, phase_name)
+
+    def AddTime(self, phase_name, wall_time, cpu_time):
+        phase = self.phases.setdefault(phase_name, [0.0, 0.0])
+        phase[0] += wall_time
+        phase[1] += cpu_time
+
+    def Count(self, counter_name, num = 1):
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + num
+
+    def Merge(self, profile):
+        """合并其他进程中同一个页签的统计"""
+        for phase_name, (wall_time, cpu_time) in profile.phases.items():
+            self.AddTime(phase_name, wall_time, cpu_time)
+        for counter_name, num in profile.counters.items():
+            self.Count(counter_name, num)
+
+    def ToDict(self):
+        return {"name": self.name,
+                "phases": dict([(phase_name, {"wall": wall_time, "cpu": cpu_time}) for phase_name, (wall_time, cpu_time) in self.phases.items()]),
+                "counters": self.counters}
+
+class _ProfilePhase:
+    def __init__(self, profile, phase_name):
+        self._profile = profile
+        self._phase_name = phase_name
+
+    def __enter__(self):
+        self._wall_begin = time.time()
+        self._cpu_begin = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._profile.AddTime(self._phase_name, time.time() - self._wall_begin, cpu_time() - self._cpu_begin)
+        return False
+
+def write_profile_report(report_file, profiles):
+    """把所有页签的统计写成json，total是所有页签的合计"""
+    total = ExportProfile("total")
+    for profile in profiles:
+        total.Merge(profile)
+    report = {"sheets": [profile.ToDict() for profile in profiles], "total": total.ToDict(),
+              "python": sys.version.split()[0], "protobuf_impl": protobuf_backend()}
+    write_file_atomic(report_file, json.dumps(report, indent = 4, sort_keys = True, separators = (',', ': ')).encode("utf-8"))
+
+def protobuf_backend():
+    """protobuf的实现：upb、cpp或python"""
+    from google.protobuf.internal import api_implementation
+    return api_implementation.Type()
+
+class ExportOptions:
+    """导出选项，对应命令行参数"""
+
+    def __init__(self, **kwargs):
+        # 逐行写出数据，不在内存中保留整个数组
+        self.stream = False
+        # 并行导出的进程数
+        self.jobs = 1
+        # 单个页签内并行解析行的进程数，行数很多时才分段
+        self.row_jobs = 1
+        # 忽略增量缓存，全部重新导出
+        self.force = False
+        # 进程内直接生成message类，不等protoc
+        self.in_process = False
+        # 输出详细程度：1打印描述树，2打印每一行
+        self.verbose = 0
+        # 分阶段耗时和计数的报告文件
+        self.profile = None
+        # ';'分割的数字数组整列转换，需要先读出所有行
+        self.columnar = False
+        # 额外输出按主键索引的数据文件
+        self.indexed = False
+        # 额外输出重复的字符串和结构体只存一份的数据文件
+        self.dedup = False
+        # 可读文本的格式：txt或jsonl
+        self.text_format = "txt"
+        # 可读文本每个文件的行数，0表示不分文件
+        self.text_shard_rows = 0
+        # 导出后校验主键唯一、数值范围和对其他页签的引用
+        self.validate = False
+        # 额外输出和上次导出的data对比的增量文件
+        self.delta = False
+        # 额外生成每个页签的python加载模块
+        self.loader = False
+        # data分片：每个分片的最多行数、最多字节数，都是0表示不分片
+        self.data_shard_rows = 0
+        self.data_shard_bytes = 0
+        for name, value in kwargs.items():
+            if not hasattr(self, name):
+                raise Exception("未知的导出选项" + name)
+            setattr(self, name, value)
+
+def message_field_values(message, path):
+    """按域路径取出所有设置过的值，路径上的数组都展开"""
+    values = [message]
+    for field_name, is_repeated in path:
+        next_values = []
+        for value in values:
+            if is_repeated:
+                next_values.extend(getattr(value, field_name))
+            elif value.HasField(field_name):
+                next_values.append(getattr(value, field_name))
+        values = next_values
+    return values
+
+class SheetValidator:
+    """导出后的校验：主键不能重复，数值要在range指定的范围内，ref引用的其他页签的主键要存在。
+    主键和范围逐行检查，引用要等所有页签都导出后统一检查。错误都收集起来一起报告"""
+
+    def __init__(self, key_field_desc, rules):
+        # 主键是数组或结构体时不检查重复
+        self._key_name = None
+        if not is_repeated_field(key_field_desc) and key_field_desc.cpp_type != 10:
+            self._key_name = key_field_desc.name
+        self._rules = rules
+        # 主键 -> 行号
+        self._keys = {}
+        # 待检查的引用[(行号, 域路径, 引用的页签, 值)]
+        self._refs = []
+        self._errors = []
+
+    def Check(self, row, item):
+        """检查一行"""
+        if self._key_name and item.HasField(self._key_name):
+            self.__add_key(row, getattr(item, self._key_name))
+        for path, value_range, ref_sheet, default_value in self._rules:
+            for value in message_field_values(item, path):
+                if value_range and ((value_range[0] is not None and value < value_range[0]) or
+                                    (value_range[1] is not None and value > value_range[1])):
+                    self._errors.append((row, "第{0}行：{1}的值{2:g}不在范围[{3}, {4}]内".format(
+                        row + 1, ".".join([field_name for field_name, _ in path]), value,
+                        "" if value_range[0] is None else "{0:g}".format(value_range[0]),
+                        "" if value_range[1] is None else "{0:g}".format(value_range[1]))))
+                # 默认值表示不引用
+                if ref_sheet and value != default_value:
+                    self._refs.append((row, path, ref_sheet, value))
+
+    def Result(self):
+        """校验结果(规则, 主键, 待检查的引用, [(行号, 错误)])，并行导出时从工作进程传回"""
+        return self._rules, self._keys, self._refs, self._errors
+
+    def Merge(self, result):
+        """合并后面一段行的校验结果，行并行解析时用。不同段之间的主键重复在这里检查"""
+        _, keys, refs, errors = result
+        prev_errors = self._errors
+        self._errors = []
+        for key, row in sorted(keys.items(), key = lambda key_row: key_row[1]):
+            self.__add_key(row, key)
+        # 按行号排序，和逐行检查时的顺序一致
+        self._errors = prev_errors + sorted(self._errors + list(errors), key = lambda row_error: row_error[0])
+        self._refs.extend(refs)
+
+    def __add_key(self, row, key):
+        if key in self._keys:
+            self._errors.append((row, "第{0}行：主键{1}和第{2}行重复".format(row + 1, key, self._keys[key] + 1)))
+        else:
+            self._keys[key] = row
+
+class KeyIndexes:
+    """页签名 -> 主键的索引，批量导出和监视模式中所有页签共用。没有导出过的页签从已有的data文件中加载"""
+
+    def __init__(self):
+        self._keys = {}
+
+    def Set(self, sheet_name, keys):
+        self._keys[sheet_name] = keys
+
+    def Get(self, sheet_name):
+        """页签的所有主键，页签没有导出过时返回None"""
+        if sheet_name not in self._keys:
+            item_array = load_exported_array(sheet_name)
+            if item_array is None:
+                return None
+            key_name = item_array.DESCRIPTOR.fields_by_name["items"].message_type.fields[0].name
+            self._keys[sheet_name] = set([getattr(item, key_name) for item in item_array.items if item.HasField(key_name)])
+        return self._keys[sheet_name]
+
+def load_exported_array(sheet_name):
+    """加载已经导出的页签数据，没有导出过时返回None"""
+    module_name = OUTPUT_FILE_BASE + sheet_name.lower() + "_pb2"
+    data_pathname = DATA_GEN_PATH + OUTPUT_FILE_BASE + sheet_name.lower() + ".data"
+    if not os.path.isfile(PYTHON_GEN_PATH + module_name + ".py") or not os.path.isfile(data_pathname):
+        return None
+    # 模块可能是导出前加载的旧版本
+    module = load_pb_module(module_name)
+    return getattr(module, sheet_name + "_ARRAY").FromString(open(data_pathname, 'rb').read())
+
+def validate_sheets(validations, cache, key_indexes):
+    """导出后统一检查引用。validations是本次导出的[((excel, 页签), 校验结果)]。
+    没有重新导出的页签如果引用了本次导出的页签，用已有的data文件重新检查。返回出错的[((excel, 页签), 错误信息)]"""
+    validations = list(validations)
+    for (_, sheet_name), (_, keys, _, _) in validations:
+        key_indexes.Set(sheet_name, keys)
+    exported_sheets = set([sheet_name for (_, sheet_name), _ in validations])
+    exported_tasks = set([sheet_task for sheet_task, _ in validations])
+    for sheet_task in cache.Tasks():
+        rules = (cache.Get(sheet_task) or {}).get("rules")
+        if sheet_task in exported_tasks or not rules or not [rule for rule in rules if rule[2] in exported_sheets]:
+            continue
+        item_array = load_exported_array(sheet_task[1])
+        if item_array is None:
+            continue
+        validator = SheetValidator(item_array.DESCRIPTOR.fields_by_name["items"].message_type.fields[0], rules)
+        for num, item in enumerate(item_array.items):
+            validator.Check(FIELD_COMMENT_ROW + 1 + num, item)
+        validations.append((sheet_task, validator.Result()))
+
+    errors = []
+    for sheet_task, (rules, keys, refs, sheet_errors) in validations:
+        sheet_errors = [error for _, error in sheet_errors]
+        missing_sheets = set()
+        for row, path, ref_sheet, value in refs:
+            ref_keys = key_indexes.Get(ref_sheet)
+            if ref_keys is None:
+                if ref_sheet not in missing_sheets:
+                    missing_sheets.add(ref_sheet)
+                    sheet_errors.append("引用的页签{0}不存在或者没有导出".format(ref_sheet))
+            elif value not in ref_keys:
+                sheet_errors.append("第{0}行：{1}的值{2}在页签{3}中不存在".format(
+                    row + 1, ".".join([field_name for field_name, _ in path]), value, ref_sheet))
+        if sheet_errors:
+            errors.append((sheet_task, "校验失败:\n" + "\n".join(sheet_errors)))
+    return errors
+
 class SheetInterpreter:
     """通过excel配置生成配置的protobuf定义文件"""
 
-    def __init__(self, xls_file, sheet_name):
-        """指定excel表和页签列表"""
+    def __init__(self, xls_file, sheet_name, workbook = None, run_protoc = True, options = None, file_proto = None):
+        """指定excel表和页签列表。workbook是open_workbook打开的excel，批量导出时多个页签共用。
+        run_protoc为False时由调用方统一调用export_protos生成python代码。
+        file_proto是进程内生成好的FileDescriptorProto，给了就直接用，不读可能正在被protoc改写的python代码"""
         self._sheet_type_name = sheet_name
+        self._options = options or ExportOptions()
+        # 分阶段耗时和计数
+        self.profile = ExportProfile(sheet_name)
         # 打开所有页签
-        workbook = xlrd.open_workbook(xls_file)
-        self._sheet = workbook.sheet_by_name(sheet_name)
+        if workbook is None:
+            workbook = open_workbook(xls_file)
+        self._sheet = workbook.GetSheet(sheet_name)
         # proto输出
-        self._pb_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".proto"
+        self._pb_file_name = sheet_pb_file_name(self._sheet_type_name)
         # py输出
         self._py_module_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + "_pb2"
+        # 加载数据的python模块
+        self._loader_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + "_loader.py"
         # data
         self._data_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".data"
-        # txt
-        self._txt_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".txt"
+        # txt，可能分成多个文件，扩展名由文本格式决定
+        self._text_file_base = TEXT_GEN_PATH + OUTPUT_FILE_BASE + self._sheet_type_name.lower()
+        # 带索引的数据
+        self._idx_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".idx"
+        # 去重后的数据
+        self._dedup_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".dedup"
+        # 和上次导出的数据对比的增量
+        self._delta_file_name = OUTPUT_FILE_BASE + self._sheet_type_name.lower() + ".delta"
+        # 上次导出的data，生成增量时才读
+        self._old_data = None
         #
         self.module = None
-        # 生成python格式
-        self.__export_proto()
+        # 导出后的校验，打开校验时才有
+        self.validator = None
+        self._run_protoc = run_protoc
+        # 本次是否重新生成了proto
+        self._proto_generated = False
+        self._file_proto = file_proto
+        # 生成python格式。进程内生成时直接用已有的python代码，只用来保持字段序号
+        if self._run_protoc and not self._options.in_process:
+            with self.profile.Phase("protoc"):
+                export_protos([self._pb_file_name])
         # 描述树
-        self._desc_tree = DescTree(self._sheet_type_name.lower(), self._sheet_type_name, self._sheet_type_name, self.__find_desc_of_exist_pb())
+        with self.profile.Phase("import"):
+            if file_proto is not None:
+                self.module = PbModule(file_proto)
+                pb_desc = self.module.DESCRIPTOR.message_types_by_name[self._sheet_type_name]
+            else:
+                pb_desc = self.__find_desc_of_exist_pb()
+        self._desc_tree = DescTree(self._sheet_type_name.lower(), self._sheet_type_name, self._sheet_type_name, pb_desc)
+        self._tree_finished = False
         # 
         self._begin_row = FIELD_COMMENT_ROW + 1
 
     def Interpreter(self) :
         """生成proto和数据"""
-        #通过第一个页签导出
-        type_sheet = self._sheet
-        # 行数太少
-        if type_sheet.nrows <= FIELD_COMMENT_ROW:
-            raise Exception("{type_sheet.name}中只有{type_sheet.nrows}行，不符合格式要求".format(**vars()))
-
-        #print("开始导出%s, excel表共%d列, 开始行:%u" % (self._pb_file_name, type_sheet.ncols, self._begin_row))
-        for col in range(type_sheet.ncols):
-            node_name = type_sheet.cell_value(FIELD_NAME_ROW, col).strip()
-            node_type = type_sheet.cell_value(FIELD_TYPE_ROW, col).strip()
-            node_desc = type_sheet.cell_value(FIELD_COMMENT_ROW, col).strip()
-            #print("第%s列， 名称：%s 类型：%s 注释：%s" % (decimal2az(col), node_name, node_type, node_desc))
-            self._desc_tree.AppendNode(node_name, node_type, node_desc, col)
-        self._desc_tree.CheckAndFinish()
-        self._desc_tree.Dump()
+        self.GenProto()
+        self.ExportData()
 
-        #  导出proto
-        self._desc_tree.GenProto(self._pb_file_name)
+    def GenProto(self):
+        """根据表头生成描述树，并导出proto"""
+        self.__build_desc_tree()
+        with self.profile.Phase("gen_proto"):
+            self._desc_tree.GenProto(self._pb_file_name)
+            if self._options.loader:
+                self._desc_tree.GenLoader(self._loader_file_name, self._py_module_name)
+            elif os.path.isfile(PYTHON_GEN_PATH + self._loader_file_name):
+                os.remove(PYTHON_GEN_PATH + self._loader_file_name)
+        self._proto_generated = True
 
-        # 重新生成proto的python描述
-        self.__export_proto(True)
-        self._desc_tree.RecheckFieldDesc(self.__find_desc_of_exist_pb())
+    def GenFileDescriptorProto(self):
+        """根据表头生成FileDescriptorProto，和GenProto生成的proto等价"""
+        self.__build_desc_tree()
+        return self._desc_tree.GenFileDescriptorProto(self._pb_file_name)
 
-        # 导出数据
+    def ExportData(self):
+        """根据最新的proto导出数据"""
+        self.__build_desc_tree()
+
+        protoc_process = None
+        if self._options.in_process:
+            # 直接用描述树生成message类，python代码只是产物，后台生成，不用等
+            if self._file_proto is None:
+                with self.profile.Phase("import"):
+                    self.module = PbModule(self._desc_tree.GenFileDescriptorProto(self._pb_file_name))
+            pb_desc = self.module.DESCRIPTOR.message_types_by_name[self._sheet_type_name]
+            if self._run_protoc and self._proto_generated:
+                protoc_process = export_protos([self._pb_file_name], True, False)
+        else:
+            # 重新生成proto的python描述
+            if self._run_protoc:
+                with self.profile.Phase("protoc"):
+                    export_protos([self._pb_file_name], True)
+            with self.profile.Phase("import"):
+                pb_desc = self.__find_desc_of_exist_pb()
+        with self.profile.Phase("finish_tree"):
+            self._desc_tree.RecheckFieldDesc(pb_desc)
+
+        try:
+            self.__export_rows()
+            self.profile.Count("skipped_defaults", self._desc_tree.Counters()["skipped_defaults"])
+        finally:
+            if protoc_process:
+                with self.profile.Phase("protoc"):
+                    protoc_process.wait()
+
+    def ReExportData(self, workbook):
+        """描述树、解码计划和message类都不变，从新打开的excel中重新导出数据。监视模式下表头没变时用"""
+        self._sheet = workbook.GetSheet(self._sheet_type_name)
+        self.profile = ExportProfile(self._sheet_type_name)
+        self._desc_tree.ResetCounters()
+        try:
+            self.__export_rows()
+            self.profile.Count("skipped_defaults", self._desc_tree.Counters()["skipped_defaults"])
+        finally:
+            self.ReleaseSheet()
+
+    def ReleaseSheet(self):
+        """不再引用页签的内容，常驻时不占内存"""
+        self._sheet = None
+
+    def __export_rows(self):
+        """导出数据"""
         # 找到array类型
         item_array = getattr(self.module, self._sheet_type_name+'_ARRAY')()
-        print("开始导出页签%s中的数据" % self._sheet.name)
-        for row in range(self._begin_row, self._sheet.nrows):
-            print("开始导出%s第%u行" % (self._sheet.name, row))
-            self._desc_tree.ParseData(item_array.items.add(), self._sheet.row_values(row))
-
-            # 写data文件
-            data_file = open(DATA_GEN_PATH + self._data_file_name, 'wb+')
-            data_file.write(item_array.SerializeToString())
-            data_file.close()
-
-            # 写text文件
-            text_file = open(TEXT_GEN_PATH + self._txt_file_name, 'wb+')
-            from google.protobuf.text_format import MessageToString
-            text_file.write(MessageToString(item_array, True)) 
-            text_file.close()
-
-    def __export_proto(self, must_succ = False):
-        # 生成python和cpp
-        full_pb_file = PROTO_GEN_PATH + self._pb_file_name
-        if os.path.exists(full_pb_file):
-            command = PROTOC_PATH + " -I{0} --python_out={1} ".format(PROTO_GEN_PATH, PYTHON_GEN_PATH) + full_pb_file
-            #print(command)
-            os.system(command)
-        elif must_succ:
-            raise Exception("文件{0}不存在.".format(full_pb_file))
+        self.__log(1, "开始导出页签%s中的数据" % self._sheet.name)
+        # 建索引时先确认主键类型，不支持的类型不用等解析完才报错
+        key_field_desc = self._desc_tree.KeyFieldDesc()
+        key_type = index_key_type(key_field_desc) if self._options.indexed else None
+        # 建索引和分片时要记下每条数据的主键。分片时主键不是单个值就不记主键范围
+        key_name = None
+        if key_type or (self.__data_sharded() and not is_repeated_field(key_field_desc) and key_field_desc.cpp_type != 10):
+            key_name = key_field_desc.name
+        validator = None
+        if self._options.validate:
+            validator = SheetValidator(self._desc_tree.KeyFieldDesc(), self._desc_tree.ValidationRules())
+        self.validator = validator
+        # 生成增量要和上次导出的data对比，写新的data前先读出来
+        data_pathname = DATA_GEN_PATH + self._data_file_name
+        if self._options.delta:
+            self._old_data = open(data_pathname, 'rb').read() if os.path.isfile(data_pathname) else b""
+        if self._options.stream:
+            # 流式导出，边解析边写，内存中只保留一行。写文件的耗时算在parse里
+            writer = StreamDataWriter(DATA_GEN_PATH + self._data_file_name, self.__text_writer())
+            item = getattr(self.module, self._sheet_type_name)()
+            keys = [] if key_name else None
+            try:
+                rows = self.__iter_rows()
+                with self.profile.Phase("parse"):
+                    for row, row_values in rows:
+                        self.__log(2, "开始导出%s第%u行" % (self._sheet.name, row))
+                        item.Clear()
+                        self.__parse_row(item, row, row_values)
+                        if validator:
+                            validator.Check(row, item)
+                        writer.Write(item)
+                        if key_name:
+                            keys.append(getattr(item, key_name))
+                        self.profile.Count("rows")
+                        self.profile.Count("cells", len(row_values))
+            except:
+                writer.Abort()
+                raise
+            with self.profile.Phase("write"):
+                writer.Close()
+            self.profile.Count("bytes_written", writer.bytes_written)
+            self.__write_data_views(key_type, keys, None)
+            return
+
+        rows = self.__iter_rows()
+        if self._options.row_jobs > 1 and _can_fork_row_workers():
+            rows = list(rows)
+            if len(rows) >= PARALLEL_CHUNK_ROWS * 2:
+                return self.__export_rows_parallel(rows, key_type, key_name)
+        with self.profile.Phase("parse"):
+            for row, row_values in rows:
+                self.__log(2, "开始导出%s第%u行" % (self._sheet.name, row))
+                item = item_array.items.add()
+                self.__parse_row(item, row, row_values)
+                if validator:
+                    validator.Check(row, item)
+                self.profile.Count("rows")
+                self.profile.Count("cells", len(row_values))
+
+        # 所有行解析完后，data文件写一次，text文件逐条写
+        with self.profile.Phase("write"):
+            data = item_array.SerializeToString()
+            texts = (TextDataWriter.Render(item, self._options.text_format) for item in item_array.items)
+            self.profile.Count("bytes_written", self.__write_data(data, texts))
+        keys = [getattr(item, key_name) for item in item_array.items] if key_name else None
+        self.__write_data_views(key_type, keys, data)
+
+    def ParseRows(self, rows, key_name):
+        """解析一段行，在行并行解析的工作进程中调用。
+        返回(序列化后的items, 每条item的文本, 主键, 校验结果, 计数)，items拼起来就是整个_ARRAY序列化后的结果"""
+        item_array = getattr(self.module, self._sheet_type_name+'_ARRAY')()
+        validator = None
+        if self._options.validate:
+            validator = SheetValidator(self._desc_tree.KeyFieldDesc(), self._desc_tree.ValidationRules())
+        self._desc_tree.ResetCounters()
+        cells = 0
+        for row, row_values in rows:
+            self.__log(2, "开始导出%s第%u行" % (self._sheet.name, row))
+            item = item_array.items.add()
+            self.__parse_row(item, row, row_values)
+            if validator:
+                validator.Check(row, item)
+            cells += len(row_values)
+        texts = [TextDataWriter.Render(item, self._options.text_format) for item in item_array.items]
+        keys = [getattr(item, key_name) for item in item_array.items] if key_name else None
+        counters = {"rows": len(rows), "cells": cells, "skipped_defaults": self._desc_tree.Counters()["skipped_defaults"]}
+        return item_array.SerializeToString(), texts, keys, validator.Result() if validator else None, counters
+
+    def __export_rows_parallel(self, rows, key_type, key_name):
+        """行很多时分段交给多个进程解析，每段传回序列化后的items和文本，按顺序拼起来写"""
+        import multiprocessing
+        global _row_parse_context
+        row_jobs = self._options.row_jobs
+        # 分段比进程数多一些，各段耗时不均匀时不会等最慢的进程
+        chunk_rows = max(PARALLEL_CHUNK_ROWS, (len(rows) + row_jobs * 4 - 1) // (row_jobs * 4))
+        chunks = [(begin, min(begin + chunk_rows, len(rows))) for begin in range(0, len(rows), chunk_rows)]
+        # 工作进程fork时继承描述树、message类和读好的所有行，只传回解析结果
+        _row_parse_context = (self, rows, key_name)
+        pool = multiprocessing.get_context("fork").Pool(min(row_jobs, len(chunks)))
+        try:
+            with self.profile.Phase("parse"):
+                results = pool.map(_parse_rows_worker, chunks, 1)
+        finally:
+            _row_parse_context = None
+            pool.close()
+            pool.join()
+
+        keys = [] if key_name else None
+        for _, _, chunk_keys, validation, counters in results:
+            if key_name:
+                keys.extend(chunk_keys)
+            if self.validator:
+                self.validator.Merge(validation)
+            for counter_name, num in counters.items():
+                self.profile.Count(counter_name, num)
+        with self.profile.Phase("write"):
+            data = b"".join([result[0] for result in results])
+            texts = (text for result in results for text in result[1])
+            self.profile.Count("bytes_written", self.__write_data(data, texts))
+        self.__write_data_views(key_type, keys, data)
+
+    def __write_data(self, data, texts):
+        """写data文件和文本文件。texts是每条item的文本，逐条写。返回写出的字节数"""
+        bytes_written = write_file_atomic(DATA_GEN_PATH + self._data_file_name, data)
+        text_writer = self.__text_writer()
+        try:
+            for text in texts:
+                text_writer.WriteText(text)
+        except:
+            text_writer.Abort()
+            raise
+        text_writer.Close()
+        return bytes_written + text_writer.bytes_written
+
+    def __text_writer(self):
+        return TextDataWriter(self._text_file_base, self._options.text_format, self._options.text_shard_rows)
+
+    def __data_sharded(self):
+        return self._options.data_shard_rows > 0 or self._options.data_shard_bytes > 0
+
+    def __write_data_views(self, key_type, keys, data):
+        """根据data文件的内容写索引文件、去重文件、增量文件和分片，data为None时mmap刚写好的data文件"""
+        if data is None:
+            # 流式导出时数据不在内存里
+            import mmap
+            data_pathname = DATA_GEN_PATH + self._data_file_name
+            if not (key_type or self._options.dedup or self._options.delta or self.__data_sharded()) or os.path.getsize(data_pathname) == 0:
+                return self.__write_data_views(key_type, keys, b"")
+            data_file = open(data_pathname, 'rb')
+            try:
+                data = mmap.mmap(data_file.fileno(), 0, access = mmap.ACCESS_READ)
+                try:
+                    return self.__write_data_views(key_type, keys, data)
+                finally:
+                    data.close()
+            finally:
+                data_file.close()
+
+        self.__write_output(key_type, "index", DATA_GEN_PATH + self._idx_file_name,
+                            lambda pathname: xls_pb_index.write_index_file(pathname, key_type, keys, data))
+        item_desc = getattr(self.module, self._sheet_type_name).DESCRIPTOR
+        self.__write_output(self._options.dedup, "dedup", DATA_GEN_PATH + self._dedup_file_name,
+                            lambda pathname: xls_pb_dedup.write_dedup_file(pathname, item_desc, data))
+        old_data, self._old_data = self._old_data, None
+        key_field_num = self._desc_tree.KeyFieldDesc().number
+        self.__write_output(self._options.delta, "delta", DATA_GEN_PATH + self._delta_file_name,
+                            lambda pathname: xls_pb_delta.write_delta_file(pathname, key_field_num, old_data, data))
+        shard_file_base = DATA_GEN_PATH + OUTPUT_FILE_BASE + self._sheet_type_name.lower()
+        if self.__data_sharded():
+            with self.profile.Phase("shard"):
+                self.profile.Count("bytes_written", write_data_shards(shard_file_base, self._sheet_type_name, data, keys,
+                                                                      self._options.data_shard_rows, self._options.data_shard_bytes))
+        else:
+            remove_data_shards(shard_file_base)
+
+    def __write_output(self, enabled, phase_name, pathname, write):
+        """写一个可选的产物。没有打开对应的选项时删除旧文件，避免和数据不一致"""
+        if not enabled:
+            if os.path.isfile(pathname):
+                os.remove(pathname)
+            return
+        with self.profile.Phase(phase_name):
+            self.profile.Count("bytes_written", write(pathname))
+
+    def __iter_rows(self):
+        """逐行返回(行号, 行内容)。列式转换时先读出所有行，把';'分割的数字列和时间列整列转换好"""
+        rows = self._sheet.IterRows(self._begin_row)
+        if not self._options.columnar:
+            return rows
+        rows = list(rows)
+        import functools
+        columns = [(col, functools.partial(convert_packed_column, col, cpp_type)) for col, cpp_type in self._desc_tree.PackedNumericColumns()]
+        columns += [(col, functools.partial(convert_time_column, convert)) for col, convert in self._desc_tree.TimeColumns()]
+        with self.profile.Phase("columnar"):
+            for col, convert in columns:
+                cell_values = [row_values[col] for _, row_values in rows]
+                try:
+                    column_values = convert(cell_values)
+                except CellValueError as error:
+                    error.row = rows[cell_values.index(error.cell_value)][0]
+                    raise
+                for (_, row_values), values in zip(rows, column_values):
+                    if values is not None:
+                        row_values[col] = values
+        return rows
+
+    def __parse_row(self, item, row, row_values):
+        """解析一行，出错时补上行号"""
+        try:
+            self._desc_tree.ParseData(item, row_values)
+        except CellValueError as error:
+            error.row = row
+            raise
+
+    def __log(self, level, message):
+        """verbose不低于level时才输出"""
+        if self._options.verbose >= level:
+            print(message)
+
+    def __build_desc_tree(self):
+        """读取表头，重建描述树"""
+        if self._tree_finished:
+            return
+        with self.profile.Phase("header"):
+            self.__parse_header()
+        with self.profile.Phase("finish_tree"):
+            self._desc_tree.CheckAndFinish()
+        if self._options.verbose >= 1:
+            self._desc_tree.Dump()
+        self._tree_finished = True
+
+    def __parse_header(self):
+        """读取表头，插入描述树"""
+        #通过第一个页签导出
+        header_rows = self._sheet.HeaderRows()
+        # 行数太少
+        if len(header_rows) <= FIELD_COMMENT_ROW:
+            raise Exception("{0}中只有{1}行，不符合格式要求".format(self._sheet.name, len(header_rows)))
+
+        DescTree.ClearUsedModules()
+        ncols = max([len(row_values) for row_values in header_rows])
+        header_rows = [row_values + [u""] * (ncols - len(row_values)) for row_values in header_rows]
+        #print("开始导出%s, excel表共%d列, 开始行:%u" % (self._pb_file_name, ncols, self._begin_row))
+        for col in range(ncols):
+            node_name = header_rows[FIELD_NAME_ROW][col].strip()
+            node_type = header_rows[FIELD_TYPE_ROW][col].strip()
+            node_desc = header_rows[FIELD_COMMENT_ROW][col].strip()
+            #print("第%s列， 名称：%s 类型：%s 注释：%s" % (decimal2az(col), node_name, node_type, node_desc))
+            self._desc_tree.AppendNode(node_name, node_type, node_desc, col)
 
     def __find_desc_of_exist_pb(self):
         # python文件也放svn，防止错误
         pb_py_full_path = PYTHON_GEN_PATH + self._py_module_name + ".py"
         if os.path.isfile(pb_py_full_path):
-            # remove loaded module
-            if self.module:
-                os.system("rm " + pb_py_full_path + "c")
-                del sys.modules[self._py_module_name]
-            self.module = __import__(self._py_module_name)
+            # 批量导出时进程会复用，模块可能是之前的页签对象加载的
+            self.module = load_pb_module(self._py_module_name)
             return self.module.DESCRIPTOR.message_types_by_name[self._sheet_type_name]
         return None
 
+def load_pb_module(module_name):
+    """加载protoc生成的模块。不import，取出其中序列化的proto描述，在单独的pool中生成message类。
+    同一个进程中页签重新生成后再import，cpp和upb实现的默认pool会报proto文件重复定义"""
+    import ast
+    from google.protobuf import descriptor_pb2
+    source = open(PYTHON_GEN_PATH + module_name + ".py", 'rb').read()
+    for node in ast.walk(ast.parse(source)):
+        if not isinstance(node, ast.Call):
+            continue
+        # 新版本protoc：AddSerializedFile(b'...')，旧版本：FileDescriptor(serialized_pb=_b('...'))
+        values = list(node.args) if getattr(node.func, "attr", None) == "AddSerializedFile" else []
+        values += [keyword.value for keyword in node.keywords if keyword.arg == "serialized_pb"]
+        for value in values:
+            if isinstance(value, ast.Call) and len(value.args) == 1:
+                value = value.args[0]
+            if isinstance(value, ast.Constant) and isinstance(value.value, (bytes, str)):
+                serialized = value.value if isinstance(value.value, bytes) else value.value.encode("latin-1")
+                return PbModule(descriptor_pb2.FileDescriptorProto.FromString(serialized))
+    raise Exception("{0}中找不到proto描述，请重新导出".format(module_name))
+
+def sheet_pb_file_name(sheet_name):
+    """页签对应的proto文件名"""
+    return OUTPUT_FILE_BASE + sheet_name.lower() + ".proto"
+
+def sheet_output_files(sheet_name, options = None):
+    """页签的所有产物：proto、python、data和text，建索引、去重、分片、生成加载模块时还有idx、dedup、分片清单、加载模块。text分文件时只检查第一个"""
+    options = options or ExportOptions()
+    file_base = OUTPUT_FILE_BASE + sheet_name.lower()
+    text_shard = 0 if options.text_shard_rows else None
+    output_files = [PROTO_GEN_PATH + file_base + ".proto", PYTHON_GEN_PATH + file_base + "_pb2.py",
+                    DATA_GEN_PATH + file_base + ".data", TextDataWriter.FileName(TEXT_GEN_PATH + file_base, options.text_format, text_shard)]
+    if options.indexed:
+        output_files.append(DATA_GEN_PATH + file_base + ".idx")
+    if options.dedup:
+        output_files.append(DATA_GEN_PATH + file_base + ".dedup")
+    if options.data_shard_rows or options.data_shard_bytes:
+        output_files.append(DATA_GEN_PATH + file_base + SHARD_MANIFEST_SUFFIX)
+    if options.loader:
+        output_files.append(PYTHON_GEN_PATH + file_base + "_loader.py")
+    return output_files
+
+def index_key_type(key_field_desc):
+    """主键对应的索引类型。主键只能是数字或字符串，不能是数组"""
+    if is_repeated_field(key_field_desc):
+        raise Exception("主键{0}是数组，不能建索引".format(key_field_desc.name))
+    if key_field_desc.cpp_type in (3, 4):
+        return xls_pb_index.KEY_UINT64
+    if key_field_desc.cpp_type in INT_CPP_TYPES:
+        return xls_pb_index.KEY_INT64
+    if key_field_desc.cpp_type == 9:
+        return xls_pb_index.KEY_STRING
+    raise Exception("主键{0}不是整数或字符串，不能建索引".format(key_field_desc.name))
+
+def export_protos(pb_file_names, must_succ = False, wait = True):
+    """生成python和cpp。多个proto只调用一次protoc。wait为False时不等protoc结束，返回protoc进程"""
+    full_pb_files = []
+    for pb_file_name in pb_file_names:
+        full_pb_file = PROTO_GEN_PATH + pb_file_name
+        if os.path.exists(full_pb_file):
+            full_pb_files.append(full_pb_file)
+        elif must_succ:
+            raise Exception("文件{0}不存在.".format(full_pb_file))
+    if not full_pb_files:
+        return None
+    command = PROTOC_PATH + " -I{0} --python_out={1} ".format(PROTO_GEN_PATH, PYTHON_GEN_PATH) + ' '.join(full_pb_files)
+    #print(command)
+    if not wait:
+        import subprocess
+        return subprocess.Popen(command, shell = True)
+    os.system(command)
+    return None
+
+def is_export_sheet(sheet_name):
+    """未指定页签时，只导出全大写的页签，如ITEM_CONF。其他页签当作说明页"""
+    import re
+    return re.match(r'^[A-Z][A-Z0-9_]*$', sheet_name) is not None
+
+def load_manifest(manifest_file):
+    """读取批量导出清单。格式：[{"xls_file": "道具表.xls", "sheets": ["ITEM_CONF"]}, ...]，省略sheets则导出全部大写页签"""
+    manifest = json.load(open(manifest_file, 'rb'))
+    return [(entry["xls_file"], [str(sheet_name) for sheet_name in entry.get("sheets", [])]) for entry in manifest]
+
+def glob_tasks(pattern):
+    """按通配符找到所有excel，导出其中全部大写页签"""
+    import glob
+    # 跳过excel打开时生成的~$临时文件
+    return [(xls_file, []) for xls_file in sorted(glob.glob(pattern)) if not os.path.basename(xls_file).startswith("~$")]
+
+def group_tasks(tasks):
+    """把(excel, 页签列表)按excel合并，返回[(excel, 页签列表)]，保持原来的顺序"""
+    from collections import OrderedDict
+    grouped_tasks = OrderedDict()
+    for xls_file, sheet_names in tasks:
+        grouped_tasks.setdefault(os.path.normpath(xls_file), []).extend(sheet_names)
+    return list(grouped_tasks.items())
+
+def list_export_sheets(xls_file, sheet_names):
+    """页签列表为空时返回excel中全部大写的页签。读列表时打开的excel留在缓存里，接着导出时不用再打开"""
+    if sheet_names:
+        return sheet_names
+    return [sheet_name for sheet_name in _open_workbook_cached(xls_file).SheetNames() if is_export_sheet(sheet_name)]
+
+def expand_tasks(tasks):
+    """把(excel, 页签列表)展开成(excel, 页签)，同一个excel的页签排在一起"""
+    sheet_tasks = []
+    for xls_file, sheet_names in group_tasks(tasks):
+        sheet_tasks += [(xls_file, sheet_name) for sheet_name in list_export_sheets(xls_file, sheet_names)]
+    return sheet_tasks
+
+# 行并行解析时每段至少的行数，行数不到两段时不并行
+PARALLEL_CHUNK_ROWS = 2000
+
+# 行并行解析的上下文(页签, 所有行, 主键名)，fork出的工作进程直接继承
+_row_parse_context = None
+
+def _can_fork_row_workers():
+    """行并行靠fork继承描述树和message类，没有fork的系统上不并行。并行导出的工作进程中也不能再开进程"""
+    import multiprocessing
+    return "fork" in multiprocessing.get_all_start_methods() and not multiprocessing.current_process().daemon
+
+def _parse_rows_worker(chunk):
+    """行并行的工作进程：解析第begin到end行"""
+    parser, rows, key_name = _row_parse_context
+    begin, end = chunk
+    return parser.ParseRows(rows[begin:end], key_name)
+
+# 当前进程最近打开的excel。同一个excel的页签连续导出时不用重复打开
+_worker_workbook = (None, None)
+
+def _open_workbook_cached(xls_file):
+    global _worker_workbook
+    if _worker_workbook[0] != xls_file:
+        _release_workbook_cached()
+        _worker_workbook = (xls_file, open_workbook(xls_file))
+    return _worker_workbook[1]
+
+def _release_workbook_cached():
+    """excel被修改后要重新打开"""
+    global _worker_workbook
+    if _worker_workbook[1]:
+        _worker_workbook[1].Release()
+    _worker_workbook = (None, None)
+
+def _prepare_sheet(sheet_task, cached, profile, options):
+    """计算页签hash，对比缓存决定要做的工作"""
+    xls_file, sheet_name = sheet_task
+    with profile.Phase("hash"):
+        hashes = ExportCache.SheetHashes(_open_workbook_cached(xls_file).GetSheet(sheet_name))
+    # 文本的格式和分文件的行数、额外生成的产物也记到缓存里
+    hashes["text"] = [options.text_format, options.text_shard_rows]
+    hashes["outputs"] = {"indexed": options.indexed, "dedup": options.dedup, "delta": options.delta, "loader": options.loader}
+    return ExportCache.CheckMode(sheet_name, hashes, cached, options), hashes
+
+def _gen_proto_worker(args):
+    """工作进程：对比缓存，需要的话生成proto。返回(工作, hash, 错误信息, 统计, 序列化的FileDescriptorProto)。
+    进程内生成message类时才返回FileDescriptorProto，导出数据时用它，不读后台protoc正在改写的python代码"""
+    sheet_task, cached, options = args
+    xls_file, sheet_name = sheet_task
+    profile = ExportProfile(sheet_name)
+    serialized_proto = None
+    try:
+        mode, hashes = _prepare_sheet(sheet_task, cached, profile, options)
+        if mode == FULL_EXPORT:
+            parser = SheetInterpreter(xls_file, sheet_name, _open_workbook_cached(xls_file), False, options)
+            parser.GenProto()
+            if options.in_process:
+                serialized_proto = parser.GenFileDescriptorProto().SerializeToString()
+            profile.Merge(parser.profile)
+    except:
+        return FULL_EXPORT, None, traceback.format_exc(), profile, None
+    return mode, hashes, None, profile, serialized_proto
+
+def _export_data_worker(args):
+    """工作进程：导出数据。返回(错误信息, 统计, 校验结果)，成功时错误信息为None"""
+    (xls_file, sheet_name), options, serialized_proto = args
+    parser = None
+    try:
+        file_proto = None
+        if serialized_proto is not None:
+            from google.protobuf import descriptor_pb2
+            file_proto = descriptor_pb2.FileDescriptorProto.FromString(serialized_proto)
+        parser = SheetInterpreter(xls_file, sheet_name, _open_workbook_cached(xls_file), False, options, file_proto)
+        parser.ExportData()
+    except:
+        return traceback.format_exc(), parser.profile if parser else ExportProfile(sheet_name), None
+    return None, parser.profile, parser.validator.Result() if parser.validator else None
+
+def _add_validation(validations, sheet_task, hashes, validation):
+    """记下页签的校验结果。校验规则也存到缓存里，页签没变但引用的页签变了时，不用重新导出就能检查引用。
+    缓存中有校验规则(可能为空)就表示这个页签校验过"""
+    if validation:
+        hashes["rules"] = validation[0]
+        validations.append((sheet_task, validation))
+
+def export_batch(tasks, options = None):
+    """批量导出。tasks是(excel, 页签列表)的列表，同一个excel只打开一次。
+    内容没变的页签直接跳过，只有数据变了的页签不重新生成proto。options.force为True时全部重新导出。
+    某个页签出错不影响其他页签，返回出错的[((excel, 页签), 错误信息)]"""
+    options = options or ExportOptions()
+    cache = ExportCache(EXPORT_CACHE_FILE)
+    # 每个页签一个统计，批量调用protoc的耗时记在batch里
+    profiles = [ExportProfile("batch")]
+    # 本次导出的页签的校验结果
+    validations = []
+    if options.jobs > 1:
+        sheet_tasks = expand_tasks(tasks)
+        # 工作进程自己打开excel，主进程读完页签列表就关掉，不能让fork出的进程共用
+        _release_workbook_cached()
+        profiles += [ExportProfile(sheet_name) for _, sheet_name in sheet_tasks]
+        errors = _export_parallel(sheet_tasks, options, cache, profiles, validations)
+    else:
+        errors = _export_serial(group_tasks(tasks), options, cache, profiles, validations)
+    if options.validate:
+        with profiles[0].Phase("validate"):
+            for sheet_task, error in validate_sheets(validations, cache, KeyIndexes()):
+                cache.Remove(sheet_task)
+                errors.append((sheet_task, error))
+    cache.Save()
+    if options.profile:
+        write_profile_report(options.profile, profiles)
+    return errors
+
+def _export_serial(grouped_tasks, options, cache, profiles, validations):
+    """逐个页签导出。导出到某个excel时才读它的页签列表，读列表打开的excel直接用来导出"""
+    errors = []
+    for xls_file, sheet_names in grouped_tasks:
+        for sheet_name in list_export_sheets(xls_file, sheet_names):
+            sheet_task = (xls_file, sheet_name)
+            profile = ExportProfile(sheet_name)
+            profiles.append(profile)
+            parser = None
+            try:
+                mode, hashes = _prepare_sheet(sheet_task, None if options.force else cache.Get(sheet_task), profile, options)
+                if mode == SKIP_EXPORT:
+                    print("%s中的页签%s没有变化，跳过" % (xls_file, sheet_name))
+                    continue
+                print("开始导出%s中的页签%s" % (xls_file, sheet_name))
+                parser = SheetInterpreter(xls_file, sheet_name, _open_workbook_cached(xls_file), mode == FULL_EXPORT, options)
+                if mode == FULL_EXPORT:
+                    parser.Interpreter()
+                else:
+                    parser.ExportData()
+                _add_validation(validations, sheet_task, hashes, parser.validator.Result() if parser.validator else None)
+                cache.Set(sheet_task, hashes)
+            except:
+                cache.Remove(sheet_task)
+                errors.append((sheet_task, traceback.format_exc()))
+            if parser:
+                profile.Merge(parser.profile)
+    return errors
+
+def _export_parallel(sheet_tasks, options, cache, profiles, validations):
+    """多进程导出。分两轮：先并行生成所有proto，统一protoc一次，再并行导出数据。
+    进程内生成message类时，导出数据不用等protoc"""
+    import multiprocessing
+    errors = []
+    protoc_process = None
+    batch_profile = profiles[0]
+    task_profiles = dict(zip(sheet_tasks, profiles[1:]))
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        # 已有的proto先统一生成一次python代码，保证字段序号不变
+        if not options.in_process:
+            with batch_profile.Phase("protoc"):
+                export_protos([sheet_pb_file_name(sheet_name) for _, sheet_name in sheet_tasks])
+        gen_results = pool.map(_gen_proto_worker, [(sheet_task, None if options.force else cache.Get(sheet_task), options) for sheet_task in sheet_tasks], 1)
+        full_tasks = []
+        data_tasks = []
+        task_hashes = {}
+        # 进程内生成的FileDescriptorProto
+        task_protos = {}
+        for sheet_task, (mode, hashes, error, profile, serialized_proto) in zip(sheet_tasks, gen_results):
+            task_profiles[sheet_task].Merge(profile)
+            if error:
+                cache.Remove(sheet_task)
+                errors.append((sheet_task, error))
+                continue
+            task_hashes[sheet_task] = hashes
+            if mode == FULL_EXPORT:
+                full_tasks.append(sheet_task)
+                task_protos[sheet_task] = serialized_proto
+            elif mode == DATA_EXPORT:
+                data_tasks.append(sheet_task)
+            else:
+                print("%s中的页签%s没有变化，跳过" % sheet_task)
+
+        with batch_profile.Phase("protoc"):
+            protoc_process = export_protos([sheet_pb_file_name(sheet_name) for _, sheet_name in full_tasks], True, not options.in_process)
+        data_tasks = full_tasks + data_tasks
+        data_results = pool.map(_export_data_worker, [(sheet_task, options, task_protos.get(sheet_task)) for sheet_task in data_tasks], 1)
+        for sheet_task, (error, profile, validation) in zip(data_tasks, data_results):
+            task_profiles[sheet_task].Merge(profile)
+            if error:
+                cache.Remove(sheet_task)
+                errors.append((sheet_task, error))
+            else:
+                _add_validation(validations, sheet_task, task_hashes[sheet_task], validation)
+                cache.Set(sheet_task, task_hashes[sheet_task])
+    finally:
+        pool.close()
+        pool.join()
+        if protoc_process:
+            with batch_profile.Phase("protoc"):
+                protoc_process.wait()
+    return errors
+
+class ExportWatcher:
+    """监视模式：进程常驻，定时检查excel，只重新导出内容有变化的页签。
+    表头没变的页签保留描述树、解码计划和message类，不用重新import和protoc，直接导出数据"""
+
+    def __init__(self, task_loader, options = None):
+        """task_loader每次检查时调用，返回(excel, 页签列表)的列表，这样新加的excel也能被发现"""
+        self._task_loader = task_loader
+        self._options = options or ExportOptions()
+        self._cache = ExportCache(EXPORT_CACHE_FILE)
+        # 只有第一次检查时忽略缓存
+        self._force = self._options.force
+        # excel -> (修改时间, 大小)
+        self._file_states = {}
+        # (excel, 页签) -> (表头hash, 导出过的SheetInterpreter)
+        self._parsers = {}
+        # 所有页签的主键索引，每次检查时更新导出了的页签
+        self._key_indexes = KeyIndexes()
+
+    def Run(self, interval):
+        """每interval秒检查一次，直到被中断"""
+        print("开始监视，每%.1f秒检查一次，Ctrl+C退出" % interval)
+        while True:
+            for (xls_file, sheet_name), error in self.Poll():
+                print("%s中的页签%s导出失败:\n%s" % (xls_file, sheet_name, error))
+            time.sleep(interval)
+
+    def Poll(self):
+        """检查一次，导出有变化的页签，返回出错的[((excel, 页签), 错误信息)]"""
+        grouped_tasks = group_tasks(self._task_loader())
+
+        errors = []
+        profiles = []
+        validations = []
+        for xls_file, sheet_names in grouped_tasks:
+            try:
+                stat = os.stat(xls_file)
+            except OSError:
+                # 文件被删掉了，或者正在保存
+                continue
+            file_state = (stat.st_mtime, stat.st_size)
+            if self._file_states.get(xls_file) == file_state:
+                continue
+            # 出错也记下来，等文件再次修改时再导出，不用每次检查都报同样的错
+            self._file_states[xls_file] = file_state
+            _release_workbook_cached()
+            try:
+                sheet_names = list_export_sheets(xls_file, sheet_names)
+            except:
+                errors.append(((xls_file, ""), traceback.format_exc()))
+                continue
+            for sheet_name in sheet_names:
+                profile = ExportProfile(sheet_name)
+                error = self.__export_sheet((xls_file, sheet_name), profile, validations)
+                if error:
+                    errors.append(((xls_file, sheet_name), error))
+                profiles.append(profile)
+        # 第一次检查完以后缓存里都是最新的
+        self._force = False
+        if self._options.validate and validations:
+            for sheet_task, error in validate_sheets(validations, self._cache, self._key_indexes):
+                self._cache.Remove(sheet_task)
+                errors.append((sheet_task, error))
+        if profiles:
+            self._cache.Save()
+            if self._options.profile:
+                write_profile_report(self._options.profile, profiles)
+        return errors
+
+    def __export_sheet(self, sheet_task, profile, validations):
+        """导出一个页签，成功时返回None"""
+        xls_file, sheet_name = sheet_task
+        begin_time = time.time()
+        try:
+            mode, hashes = _prepare_sheet(sheet_task, None if self._force else self._cache.Get(sheet_task), profile, self._options)
+            if mode == SKIP_EXPORT:
+                return None
+            workbook = _open_workbook_cached(xls_file)
+            header_hash, parser = self._parsers.get(sheet_task, (None, None))
+            if mode == DATA_EXPORT and header_hash == hashes["header"]:
+                parser.ReExportData(workbook)
+            else:
+                parser = SheetInterpreter(xls_file, sheet_name, workbook, mode == FULL_EXPORT, self._options)
+                if mode == FULL_EXPORT:
+                    parser.Interpreter()
+                else:
+                    parser.ExportData()
+                parser.ReleaseSheet()
+                self._parsers[sheet_task] = (hashes["header"], parser)
+            profile.Merge(parser.profile)
+            _add_validation(validations, sheet_task, hashes, parser.validator.Result() if parser.validator else None)
+            self._cache.Set(sheet_task, hashes)
+        except:
+            self._cache.Remove(sheet_task)
+            self._parsers.pop(sheet_task, None)
+            return traceback.format_exc()
+        print("%s中的页签%s导出完成，耗时%.3f秒" % (xls_file, sheet_name, time.time() - begin_time))
+        return None
+
 if __name__ == '__main__' :
     """入口"""
-    if len(sys.argv) < 3 :
-        print("Usage: %s sheet_name|sheet_name(should be upper) xls_file" % sys.argv[0])
+    import argparse
+    arg_parser = argparse.ArgumentParser(usage = "%(prog)s [options] sheet_name|sheet_name(should be upper) xls_file\n"
+                                                 "       %(prog)s [options] --manifest manifest.json | --glob 'excel/*.xls'")
+    arg_parser.add_argument("sheet_name", nargs = "?")
+    arg_parser.add_argument("xls_file", nargs = "?")
+    arg_parser.add_argument("--stream", action = "store_true", help = u"逐行写出数据，适合行数很多的表")
+    arg_parser.add_argument("--manifest", help = u"批量导出清单(json)")
+    arg_parser.add_argument("--glob", help = u"批量导出匹配的所有excel中的大写页签")
+    arg_parser.add_argument("-j", "--jobs", type = int, default = 1, help = u"并行导出的进程数")
+    arg_parser.add_argument("--row-jobs", type = int, default = 1, help = u"单个页签内并行解析行的进程数，行数很多时才生效，--stream时不生效")
+    arg_parser.add_argument("--force", action = "store_true", help = u"忽略增量缓存，全部重新导出")
+    arg_parser.add_argument("--in-process", action = "store_true", help = u"进程内直接生成message类，不等protoc")
+    arg_parser.add_argument("-v", "--verbose", action = "count", default = 0, help = u"-v打印描述树，-vv打印每一行")
+    arg_parser.add_argument("--profile", help = u"把分阶段耗时和计数写到json文件")
+    arg_parser.add_argument("--columnar", action = "store_true", help = u"';'分割的数字数组整列转换(有numpy时更快)，需要先读出所有行")
+    arg_parser.add_argument("--indexed", action = "store_true", help = u"额外输出按主键索引的数据文件(.idx)，可以mmap按主键读取")
+    arg_parser.add_argument("--dedup", action = "store_true", help = u"额外输出去重的数据文件(.dedup)，重复的字符串和结构体只存一份")
+    arg_parser.add_argument("--text-format", choices = sorted(TextDataWriter.EXTENSIONS), default = "txt", help = u"可读文本的格式，jsonl为每条数据一行json")
+    arg_parser.add_argument("--text-shard-rows", type = int, default = 0, help = u"可读文本每个文件的行数，默认不分文件")
+    arg_parser.add_argument("--data-shard-rows", type = int, default = 0, help = u"额外把data按行数分片，每个分片是独立的_ARRAY")
+    arg_parser.add_argument("--data-shard-bytes", type = int, default = 0, help = u"额外把data按字节数分片，每个分片是独立的_ARRAY")
+    arg_parser.add_argument("--delta", action = "store_true", help = u"额外输出和上次导出的data对比的增量文件，按主键列出新增、修改和删除的数据")
+    arg_parser.add_argument("--loader", action = "store_true", help = u"额外生成每个页签的python加载模块，按主键和index特性的字段建索引")
+    arg_parser.add_argument("--validate", action = "store_true", help = u"导出后校验主键唯一、range指定的数值范围和ref引用的其他页签的主键")
+    arg_parser.add_argument("--watch", action = "store_true", help = u"常驻监视excel，只重新导出有变化的页签")
+    arg_parser.add_argument("--watch-interval", type = float, default = 1.0, help = u"监视模式下检查的间隔(秒)")
+    args = arg_parser.parse_args()
+
+    def load_tasks():
+        """每次调用都重新读取清单、匹配excel，监视模式下能发现新加的excel"""
+        tasks = []
+        if args.manifest:
+            tasks += load_manifest(args.manifest)
+        if args.glob:
+            tasks += glob_tasks(args.glob)
+        if args.sheet_name and args.xls_file:
+            tasks.append((args.xls_file, [args.sheet_name]))
+        return tasks
+
+    tasks = load_tasks()
+    if not tasks and not (args.watch and (args.manifest or args.glob)):
+        arg_parser.print_usage()
         sys.exit(-1)
 
+    options = ExportOptions(stream = args.stream, jobs = args.jobs, force = args.force, in_process = args.in_process,
+                            row_jobs = args.row_jobs, verbose = args.verbose, profile = args.profile, columnar = args.columnar, indexed = args.indexed,
+                            dedup = args.dedup, text_format = args.text_format, text_shard_rows = args.text_shard_rows,
+                            validate = args.validate, delta = args.delta, data_shard_rows = args.data_shard_rows, data_shard_bytes = args.data_shard_bytes,
+                            loader = args.loader)
+    # 纯python实现的解析和序列化要慢好几倍
+    if protobuf_backend() == "python":
+        print("protobuf使用的是纯python实现，导出会很慢。4.21以上的protobuf默认使用upb实现，"
+              "也请检查PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION环境变量")
+    if args.watch:
+        try:
+            ExportWatcher(load_tasks, options).Run(args.watch_interval)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     try:
-        parser = SheetInterpreter(sys.argv[2], sys.argv[1])
-        parser.Interpreter()
+        errors = export_batch(tasks, options)
     except:
         traceback.print_exc()
         sys.exit(-1)
-    else:
-        sys.exit(0)
-
+    if errors:
+        for (xls_file, sheet_name), error in errors:
+            print("%s中的页签%s导出失败:\n%s" % (xls_file, sheet_name, error))
+        sys.exit(-1)
+    sys.exit(0)